@@ -0,0 +1,437 @@
+"""Benchmarks for compressit.py
+
+Usage:
+    python benchmark.py scaling [--files 200] [--engines thread process]
+    python benchmark.py import [--runs 20]
+    python benchmark.py suite [--output baseline.json] [--compare old.json]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import PIL
+import pillow_heif
+from PIL import Image, ImageDraw
+
+from media_compressor import MediaCompressor
+
+
+def make_noise(size, sigma, rng):
+    """Gray noise around 128 with roughly sigma as standard deviation, drawn from rng
+
+    Image.effect_noise uses the C library's rand(), which no seed reaches and
+    whose state depends on whatever called it before.
+    """
+    noise = Image.frombytes('L', size, rng.randbytes(size[0] * size[1]))
+    # Uniform bytes have a standard deviation of about 74
+    scale = sigma / 74
+    return noise.point(lambda v: max(0, min(255, round(128 + (v - 128) * scale))))
+
+
+def make_noisy_image(size, rng):
+    """Smooth gradient plus noise, so the encoder has real work to do"""
+    base = Image.linear_gradient('L').resize(size).convert('RGB')
+    noise = make_noise(size, rng.randint(20, 60), rng).convert('RGB')
+    return Image.blend(base, noise, 0.35)
+
+
+def make_test_images(directory, count, size=(1600, 1200), seed=0):
+    """Write a deterministic set of noisy high-quality JPEGs to compress"""
+    rng = random.Random(seed)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i in range(count):
+        img = make_noisy_image(size, rng)
+        path = directory / f"image_{i:04d}.jpg"
+        img.save(path, quality=97)
+        files.append(path)
+    return files
+
+
+def make_graphic(size, rng, alpha=False):
+    """Screenshot-like image: flat colours, shapes and a soft gradient"""
+    img = Image.linear_gradient('L').resize(size).convert('RGBA' if alpha else 'RGB')
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        x1, y1 = x0 + rng.randrange(20, size[0] // 3), y0 + rng.randrange(20, size[1] // 3)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if alpha:
+            color += (rng.randrange(64, 256),)
+        if rng.random() < 0.5:
+            draw.rectangle([x0, y0, x1, y1], fill=color)
+        else:
+            draw.ellipse([x0, y0, x1, y1], fill=color)
+    if alpha:
+        img.putalpha(Image.linear_gradient('L').rotate(90).resize(size))
+    return img
+
+
+def make_test_videos(directory, count, ffmpeg_path, seconds=3, size='640x360', seed=0):
+    """Write short test-pattern clips with a sine tone using ffmpeg's lavfi sources
+
+    Encoded single-threaded at a low CRF with seeded noise, so the files are
+    identical between runs and there is plenty left for the compressor to save.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    files = []
+    for i in range(count):
+        path = directory / f"video_{i:04d}.mp4"
+        subprocess.run([
+            ffmpeg_path, '-hide_banner', '-nostdin', '-loglevel', 'error', '-y',
+            # Temporal noise keeps the bitrate realistic, a clean test pattern is nearly free to encode
+            '-f', 'lavfi', '-i', f"testsrc2=size={size}:rate=30:duration={seconds},noise=alls=12:allf=t+u:all_seed={seed + i}",
+            '-f', 'lavfi', '-i', f"sine=frequency={220 + 110 * ((seed + i) % 8)}:duration={seconds}",
+            '-c:v', 'libx264', '-crf', '12', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-b:a', '192k', '-threads', '1', '-fflags', '+bitexact', str(path)
+        ], check=True)
+        files.append(path)
+    return files
+
+
+def make_corpus(directory, images=20, videos=2, seed=0, ffmpeg_path=None):
+    """Generate the benchmark corpus, returns {format name: [files]}
+
+    Everything is derived from seed, each folder from its own generator, so
+    the same arguments always produce the same files. Existing folders are
+    reused without changing the others, delete the directory to regenerate.
+    """
+    directory = Path(directory)
+    corpus = {}
+
+    for quality in (95, 85, 70):
+        name = f"jpeg_q{quality}"
+        folder = directory / name
+        if not folder.is_dir():
+            folder.mkdir(parents=True)
+            rng = random.Random(f"{seed}:{name}")
+            for i in range(images):
+                make_noisy_image((1600, 1200), rng).save(folder / f"image_{i:04d}.jpg", quality=quality)
+        corpus[name] = sorted(folder.iterdir())
+
+    for name, alpha in (('png_rgb', False), ('png_rgba', True)):
+        folder = directory / name
+        if not folder.is_dir():
+            folder.mkdir(parents=True)
+            rng = random.Random(f"{seed}:{name}")
+            for i in range(images):
+                make_graphic((1280, 800), rng, alpha).save(folder / f"image_{i:04d}.png")
+        corpus[name] = sorted(folder.iterdir())
+
+    folder = directory / 'heic'
+    if not folder.is_dir():
+        folder.mkdir(parents=True)
+        pillow_heif.register_heif_opener()
+        rng = random.Random(f"{seed}:heic")
+        for i in range(images):
+            make_noisy_image((1600, 1200), rng).save(folder / f"image_{i:04d}.heic", format='HEIF', quality=95)
+    corpus['heic'] = sorted(folder.iterdir())
+
+    folder = directory / 'video_h264'
+    if videos and ffmpeg_path and shutil.which(ffmpeg_path):
+        if not folder.is_dir():
+            make_test_videos(folder, videos, ffmpeg_path, seed=seed)
+        corpus['video_h264'] = sorted(folder.iterdir())
+    elif videos:
+        print("ffmpeg not found, skipping videos", file=sys.stderr)
+    return corpus
+
+
+def peak_rss_mb(children=False):
+    """Peak resident set size of this process or its largest child, None where unsupported"""
+    if not children:
+        # ru_maxrss survives exec on Linux and would report the parent's peak, VmHWM doesn't
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes everywhere else
+    return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+
+
+def run_case(files, engine, workers, quality, use_hardware):
+    """Compress files once and return the measurements, called in a fresh interpreter"""
+    files = [Path(f) for f in files]
+    work_dir = Path(tempfile.mkdtemp(prefix='compressit_case_'))
+    try:
+        with MediaCompressor() as compressor:
+            is_video = files[0].suffix.lower() in compressor.supported_video_formats
+            if engine == 'process' and not is_video:
+                # Start the pool outside the timed region
+                compressor._get_image_pool(workers)
+            start = time.perf_counter()
+            compressor.compress_directory(
+                files, work_dir, quality, 1 if is_video else workers,
+                use_hardware=use_hardware, codec='h264',
+                engine=engine, video_workers=workers if is_video else 1
+            )
+            elapsed = time.perf_counter() - start
+            results = compressor.results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    input_bytes = sum(f.stat().st_size for f in files)
+    # Files that were skipped or failed keep their original size
+    output_bytes = input_bytes - sum(r.bytes_saved for r in results)
+    return {
+        'files': len(files),
+        'seconds': elapsed,
+        'input_bytes': input_bytes,
+        'output_bytes': output_bytes,
+        'compressed': sum(1 for r in results if r.outcome == 'compressed'),
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_child_rss_mb': peak_rss_mb(children=True)
+    }
+
+
+def _run_case_main():
+    """Entry point of the child interpreter started by measure_case"""
+    print(json.dumps(run_case(**json.loads(sys.argv[1]))))
+
+
+def measure_case(files, engine, workers, quality, use_hardware):
+    """Run one case in a fresh interpreter, so peak RSS isn't carried over from earlier cases"""
+    case = {'files': [str(f) for f in files], 'engine': engine, 'workers': workers,
+            'quality': quality, 'use_hardware': use_hardware}
+    result = subprocess.run(
+        [sys.executable, '-c', 'import benchmark; benchmark._run_case_main()', json.dumps(case)],
+        capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+    )
+    # The compressor prints progress to stdout as well, the result is the last line
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    """Measure every corpus format at each worker count and write a JSON baseline"""
+    ffmpeg_path = shutil.which('ffmpeg')
+    corpus_dir = args.corpus or Path(tempfile.mkdtemp(prefix='compressit_corpus_'))
+    try:
+        corpus = make_corpus(corpus_dir, args.images, args.videos, args.seed, ffmpeg_path)
+        if args.formats:
+            corpus = {name: files for name, files in corpus.items() if name in args.formats}
+
+        results = []
+        print(f"{'format':<11} {'engine':<8} {'workers':>7} {'files/s':>8} {'MB/s':>7} {'ratio':>6} {'RSS MB':>7} {'child':>6}")
+        for name, files in corpus.items():
+            engines = ['thread'] if name.startswith('video') else args.engines
+            for engine in engines:
+                for workers in worker_counts(args.max_workers):
+                    runs = [measure_case(files, engine, workers, args.quality, args.hardware)
+                            for _ in range(args.repeat)]
+                    seconds = statistics.median(run['seconds'] for run in runs)
+                    run = runs[0]
+                    result = {
+                        'format': name,
+                        'engine': engine,
+                        'workers': workers,
+                        'files': run['files'],
+                        'compressed': run['compressed'],
+                        'input_bytes': run['input_bytes'],
+                        'output_bytes': run['output_bytes'],
+                        'seconds': round(seconds, 4),
+                        'files_per_second': round(run['files'] / seconds, 3),
+                        'mb_per_second': round(run['input_bytes'] / seconds / (1024 * 1024), 3),
+                        'ratio': round(run['output_bytes'] / run['input_bytes'], 4),
+                        'peak_rss_mb': max((r['peak_rss_mb'] or 0) for r in runs) or None,
+                        'peak_child_rss_mb': max((r['peak_child_rss_mb'] or 0) for r in runs) or None
+                    }
+                    results.append(result)
+                    rss, child_rss = (f"{result[key]:.0f}" if result[key] else '-'
+                                      for key in ('peak_rss_mb', 'peak_child_rss_mb'))
+                    print(f"{name:<11} {engine:<8} {workers:>7} {result['files_per_second']:>8.1f} "
+                          f"{result['mb_per_second']:>7.1f} {result['ratio']:>6.3f} {rss:>7} {child_rss:>6}")
+    finally:
+        if not args.corpus:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    baseline = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'quality': args.quality,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'hardware': args.hardware
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare_baselines(json.load(f), baseline)
+
+
+def compare_baselines(old, new):
+    """Print the change of every metric between two baselines, matched by format, engine and workers"""
+    key = lambda r: (r['format'], r['engine'], r['workers'])
+    previous = {key(r): r for r in old['results']}
+    print(f"\nCompared to {old['meta'].get('revision') or 'baseline'}:")
+    print(f"{'format':<11} {'engine':<8} {'workers':>7} {'files/s':>9} {'MB/s':>9} {'ratio':>9} {'RSS':>9}")
+    for result in new['results']:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        changes = []
+        for metric in ('files_per_second', 'mb_per_second', 'ratio', 'peak_rss_mb'):
+            if before.get(metric) and result.get(metric):
+                changes.append(f"{(result[metric] / before[metric] - 1) * 100:>+8.1f}%")
+            else:
+                changes.append(f"{'-':>9}")
+        print(f"{result['format']:<11} {result['engine']:<8} {result['workers']:>7} {' '.join(changes)}")
+
+
+def worker_counts(max_workers):
+    """1, 2, 4, ... up to and including max_workers"""
+    counts = []
+    n = 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(max_workers)
+    return counts
+
+
+def bench_scaling(args):
+    """Measure image files/s of compress_directory for each engine and worker count"""
+    work_dir = Path(tempfile.mkdtemp(prefix='compressit_bench_'))
+    try:
+        files = make_test_images(work_dir / 'input', args.files)
+        print(f"{'engine':<8} {'workers':>7} {'seconds':>8} {'files/s':>8} {'speedup':>8}")
+        for engine in args.engines:
+            baseline = None
+            with MediaCompressor() as compressor:
+                for workers in worker_counts(args.max_workers):
+                    output_dir = work_dir / f"out_{engine}_{workers}"
+                    output_dir.mkdir()
+                    if engine == 'process':
+                        # Start the pool outside the timed region, it is reused between runs
+                        compressor._get_image_pool(workers)
+                    start = time.perf_counter()
+                    compressor.compress_directory(files, output_dir, args.quality, workers, engine=engine)
+                    elapsed = time.perf_counter() - start
+                    rate = len(files) / elapsed
+                    baseline = baseline or rate
+                    print(f"{engine:<8} {workers:>7} {elapsed:>8.2f} {rate:>8.1f} {rate / baseline:>7.2f}x")
+                    shutil.rmtree(output_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def import_times(module):
+    """Import module in a fresh interpreter and return {module: cumulative us}
+
+    Besides the module itself only its direct imports are returned, not
+    their dependencies or what the interpreter loads at startup.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, check=True, cwd=Path(__file__).parent
+    )
+    times = {}
+    children = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Children are listed before their parent, indented two spaces per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children[name.strip()] = int(cumulative)
+        elif depth == 0:
+            if name.strip() == module:
+                times = dict(children)
+                times[module] = int(cumulative)
+            children = {}
+    return times
+
+
+def bench_import(args):
+    """Measure the cost of `import media_compressor` in a fresh interpreter"""
+    runs = [import_times('media_compressor') for _ in range(args.runs)]
+    total = statistics.median(run['media_compressor'] for run in runs)
+    print(f"import media_compressor: {total / 1000:.1f} ms (median of {args.runs} runs)")
+
+    print("Slowest direct imports:")
+    names = {name for run in runs for name in run if name != 'media_compressor'}
+    medians = {name: statistics.median(run.get(name, 0) for run in runs) for name in names}
+    for name, us in sorted(medians.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {name:<32} {us / 1000:>7.1f} ms")
+
+    # Tk and friends must not be pulled in by the compression engine
+    heavy = {'tkinter', 'tkinterdnd2', 'moviepy', 'matplotlib'} & names
+    if heavy:
+        print(f"Warning: GUI modules imported: {', '.join(sorted(heavy))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compressit.py benchmarks")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scaling = subparsers.add_parser('scaling', help="image throughput vs. worker count")
+    scaling.add_argument('--files', type=int, default=200)
+    scaling.add_argument('--quality', type=int, default=80)
+    scaling.add_argument('--max-workers', type=int, default=multiprocessing.cpu_count())
+    scaling.add_argument('--engines', nargs='+', choices=['thread', 'process'], default=['thread', 'process'])
+    scaling.set_defaults(func=bench_scaling)
+
+    startup = subparsers.add_parser('import', help="startup cost of importing media_compressor")
+    startup.add_argument('--runs', type=int, default=20)
+    startup.add_argument('--top', type=int, default=10)
+    startup.set_defaults(func=bench_import)
+
+    suite = subparsers.add_parser('suite', help="throughput, memory and ratio per format, written as a JSON baseline")
+    suite.add_argument('--corpus', type=Path, help="keep the generated corpus here and reuse it on later runs")
+    suite.add_argument('--images', type=int, default=20, help="images per format")
+    suite.add_argument('--videos', type=int, default=2)
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--formats', nargs='+', help="only these corpus formats, e.g. jpeg_q95 png_rgba")
+    suite.add_argument('--quality', type=int, default=80)
+    suite.add_argument('--max-workers', type=int, default=multiprocessing.cpu_count())
+    suite.add_argument('--engines', nargs='+', choices=['thread', 'process'], default=['thread', 'process'])
+    suite.add_argument('--repeat', type=int, default=3, help="runs per case, the median time is reported")
+    suite.add_argument('--hardware', action='store_true', help="allow hardware video encoders")
+    suite.add_argument('--output', type=Path, help="write the results to this JSON file")
+    suite.add_argument('--compare', type=Path, help="print the change against an earlier baseline")
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
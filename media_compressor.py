@@ -1,75 +1,2116 @@
 from pathlib import Path
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import pillow_heif
-from typing import List, Dict
+from typing import List, Dict, Iterator, NamedTuple, Optional
+import io
+import math
 import os
+import sys
 import subprocess
 import shutil
-from moviepy.editor import VideoFileClip
-from PIL import ImageOps
+from PIL import JpegImagePlugin
+from PIL import features
 from concurrent.futures import ThreadPoolExecutor
-import multiprocessing
 import threading
 import ffmpeg
 import concurrent.futures
+import contextvars
+import hashlib
+import heapq
+from collections import deque
+import queue
+import sqlite3
+import time
+import zlib
 from functools import lru_cache
-import tkinter as tk
-import tkinter.filedialog as filedialog
-import tkinter.messagebox as messagebox
-import tkinter.ttk as ttk
 import json
-from tkinterdnd2 import *
+import tempfile
+import csv
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# IJG luminance quantization table for quality 50, the reference libjpeg
+# scales to reach other qualities (see _analyze_jpeg)
+_IJG_LUMINANCE_TABLE = [
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99
+]
+
+# pre_skip only skips a 4:2:0 JPEG from its headers when its estimated
+# quality is at least this far below the requested one and it has at least
+# this many bits per pixel. Closer qualities and small files (where
+# headers and unoptimized Huffman tables weigh more) still shrank by more
+# than 5% when re-encoded, see _analyze_jpeg.
+_JPEG_SKIP_QUALITY_MARGIN = 15
+_JPEG_SKIP_MIN_BPP = 1.5
+
+# Rough bits per pixel per frame libx264 lands on at CRF 23, HEVC needs about
+# 40% less for the same quality. Every 6 CRF steps halve the bitrate.
+_VIDEO_BPP_AT_CRF23 = {'h264': 0.1, 'h265': 0.06}
+# A video is skipped up front when the predicted encode is at least this many
+# times the source video bitrate
+_VIDEO_SKIP_MARGIN = 1.0
+
+# Hardware encoders per codec, in order of preference
+_HW_ENCODERS = {
+    'h265': ['hevc_nvenc', 'hevc_qsv', 'hevc_amf', 'hevc_videotoolbox', 'hevc_vaapi'],
+    'h264': ['h264_nvenc', 'h264_qsv', 'h264_amf', 'h264_videotoolbox', 'h264_vaapi']
+}
+_VAAPI_DEVICE = '/dev/dri/renderD128'
+
+# Software encodes of videos at least this long (seconds) are split at
+# keyframes into segments of about _SEGMENT_SECONDS and encoded in parallel
+_SEGMENT_MIN_DURATION = 600
+_SEGMENT_SECONDS = 60
+# Last lines of ffmpeg's stderr kept for the error of a failed run
+_FFMPEG_STDERR_LINES = 50
+
+# Format an image is re-encoded in when only its content is known, see
+# compress_image_bytes; HEIC and multi-picture JPEGs become plain JPEGs
+_REENCODE_FORMATS = {'JPEG': 'JPEG', 'MPO': 'JPEG', 'HEIF': 'JPEG', 'PNG': 'PNG', 'WEBP': 'WEBP'}
+# Suffix of a rendition file per output format
+_FORMAT_SUFFIXES = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'HEIF': '.heic'}
+# Downscales first shrink by a whole factor with Image.reduce while the
+# result stays this many times the target, then resample what's left
+_REDUCING_GAP = 3.0
+
+# zlib strategies tried for PNGs, in order, all at level 9. Pillow picks the
+# row filters itself, Z_FILTERED and Z_RLE suit its filtered rows best
+_PNG_STRATEGIES = (
+    ('default', zlib.Z_DEFAULT_STRATEGY),
+    ('filtered', zlib.Z_FILTERED),
+    ('rle', zlib.Z_RLE),
+    ('huffman', zlib.Z_HUFFMAN_ONLY)
+)
+# CPU seconds one PNG may spend on encodes; the first one always runs, the
+# next only if another encode as long as the last still fits. The HEIF
+# fallback comes out of what is left, by its estimated wall time.
+_PNG_TIME_BUDGET = 2.0
+# Wall seconds per pixel of a HEIF encode, until one was timed (x265 on one core)
+_HEIF_SECONDS_PER_PIXEL = 4.5e-6
+
+# Decoded pixel buffers compress_image holds at once at worst: the decoded
+# image plus a rotated copy or the encoder's converted one
+_DECODE_COPIES = 2
+# PNGs also hold a reduced copy and two raw byte copies to check it's exact
+_PNG_DECODE_COPIES = 4
+
+# Marks temp files and directories, iter_media never yields anything carrying it
+_TEMP_MARKER = '.compressit-tmp'
+# Containers a video can be re-encoded into in place, under its own name
+_IN_PLACE_VIDEO_FORMATS = {'.mp4', '.mkv', '.mov'}
+
+# Per-process compressor used by the image process pool (see _init_image_worker)
+_worker_compressor = None
+
+class _AtomicOutput:
+    """Temp file next to path that replaces path in one step on commit().
+
+    Whatever writes the file (we or ffmpeg) writes to tmp. commit() flushes
+    it to disk and os.replace()s it over path, so path is either the old or
+    the complete new file, also after a crash. Leaving the with block without
+    commit() removes the temp file. With like, the owner (where allowed),
+    permissions and times of that file are copied to the new one.
+    """
+    def __init__(self, path, like=None):
+        self.path = Path(path)
+        self.like = like
+        # Created like open() would, so the umask of the moment applies
+        # instead of mkstemp's 0600
+        while True:
+            tmp = self.path.with_name(f'.{self.path.stem}.{os.urandom(4).hex()}{_TEMP_MARKER}{self.path.suffix}')
+            try:
+                fd = os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            except FileExistsError:
+                continue
+            break
+        os.close(fd)
+        self.tmp = tmp
+
+    def commit(self):
+        with open(self.tmp, 'rb+') as f:
+            os.fsync(f.fileno())
+        if self.like is not None:
+            if hasattr(os, 'chown'):
+                st = os.stat(self.like)
+                try:
+                    os.chown(self.tmp, st.st_uid, st.st_gid)
+                except PermissionError:
+                    # Only root can give files away, others keep them as their own
+                    pass
+            # After chown, which may clear setuid and setgid bits
+            shutil.copystat(self.like, self.tmp)
+        os.replace(self.tmp, self.path)
+        self.tmp = None
+
+    def discard(self):
+        if self.tmp is not None:
+            try:
+                os.unlink(self.tmp)
+            except OSError:
+                pass
+            self.tmp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.discard()
+        return False
+
+def _video_output_path(input_path, output_path):
+    """The file compress_video writes for output_path, which gets .mp4 appended unless it is mp4, mkv or in place"""
+    output_path = str(output_path)
+    if os.path.abspath(output_path) == os.path.abspath(input_path) or output_path.lower().endswith(('.mp4', '.mkv')):
+        return output_path
+    return output_path + '.mp4'
+
+class _FfmpegProgress:
+    """Parser of ffmpeg's -progress output, shared by the blocking and asyncio ffmpeg runners.
+
+    ffmpeg writes blocks of key=value lines, each closed by a progress= line;
+    feed() takes the lines one at a time.
+    """
+    def __init__(self, duration=None, current_file=None):
+        self.duration = duration
+        self.current_file = current_file
+        self._block = {}
+
+    def feed(self, raw_line):
+        """Take one line of stdout, returns the 'video_progress' event of a completed block, else None"""
+        key, _, value = raw_line.decode(errors='replace').strip().partition('=')
+        if key != 'progress':
+            self._block[key] = value
+            return None
+        event = MediaCompressor._progress_event(self._block, value, self.duration, self.current_file)
+        self._block = {}
+        return event
+
+def _remove_temp_files(directory):
+    """Delete the temp files and directories interrupted writes left in directory, returns how many"""
+    try:
+        entries = [entry for entry in os.scandir(directory) if _TEMP_MARKER in entry.name]
+    except OSError:
+        return 0
+    removed = 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+            removed += 1
+        except OSError as e:
+            print(f"Could not remove {entry.path}: {e}")
+    return removed
+
+class _BufferReader(io.RawIOBase):
+    """Seekable read-only file over a buffer without copying it.
+
+    Only the bytes a read() returns are copied, unlike io.BytesIO which
+    copies bytearrays and memoryviews up front.
+    """
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        start = self._pos
+        end = len(self._view) if size is None or size < 0 else min(start + size, len(self._view))
+        self._pos = max(start, end)
+        return self._view[start:end].tobytes()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return offset
+
+    def tell(self):
+        return self._pos
+
+class _FileWindow(io.RawIOBase):
+    """Read-only view of a seekable file from offset start on.
+
+    Positions count from start, so Pillow, which seeks to 0 before reading,
+    opens an image that begins in the middle of the file.
+    """
+    def __init__(self, f, start):
+        self._f = f
+        self._start = start
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def readinto(self, b):
+        data = self._f.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            if offset < 0:
+                raise ValueError("negative seek position")
+            offset += self._start
+        return self._f.seek(offset, whence) - self._start
+
+    def tell(self):
+        return self._f.tell() - self._start
+
+def _image_source(data):
+    """Return a file object Pillow can open over in-memory image data and its size.
+
+    Buffers (bytes, bytearray, memoryview, ...) are wrapped without a copy.
+    Seekable file objects are read from their current position on, like
+    others, which are read into memory once.
+    """
+    if hasattr(data, 'read'):
+        if data.seekable():
+            start = data.tell()
+            size = data.seek(0, io.SEEK_END) - start
+            data.seek(start)
+            return (data if start == 0 else _FileWindow(data, start)), size
+        data = data.read()
+    try:
+        view = memoryview(data).cast('B')
+    except TypeError:
+        # Not contiguous, only a copy can be read sequentially
+        view = memoryview(memoryview(data).tobytes())
+    return _BufferReader(view), view.nbytes
+
+def _decoded_image_bytes(path):
+    """Estimate the memory decoding an image takes from its header, None if it can't be read"""
+    try:
+        with Image.open(path) as img:
+            width, height = img.size
+            mode = img.mode
+            copies = _PNG_DECODE_COPIES if img.format == 'PNG' else _DECODE_COPIES
+    except Exception:
+        return None
+    # Pillow keeps multi-band pixels in 32 bits
+    if mode in ('1', 'L', 'P'):
+        pixel_bytes = 1
+    elif mode.startswith('I;16'):
+        pixel_bytes = 2
+    else:
+        pixel_bytes = 4
+    return width * height * pixel_bytes * copies
+
+def _peak_rss():
+    """Peak resident memory of this process so far in bytes, None where unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _reduce_png(img):
+    """Return img in the smallest mode that holds exactly the same pixels.
+
+    Drops an alpha channel that is opaque everywhere, turns gray RGB into L
+    and images with few enough colours into a palette. Every reduction is
+    checked against the original pixels and dropped if it isn't exact.
+    """
+    # A colour key transparency only fits the mode it was stored for
+    if img.mode not in ('RGB', 'RGBA', 'L', 'LA') or 'transparency' in img.info:
+        return img
+    original = img
+    if img.mode in ('RGBA', 'LA') and img.getchannel('A').getextrema() == (255, 255):
+        img = img.convert(img.mode[:-1])
+    if img.mode in ('RGB', 'RGBA'):
+        red, green, blue = (img.getchannel(band).tobytes() for band in 'RGB')
+        if red == green == blue:
+            img = img.convert('LA' if img.mode == 'RGBA' else 'L')
+        del red, green, blue
+    # An 8 bit palette is no smaller than 8 bit gray, only 16 levels or less pay off
+    colors = img.getcolors(16 if img.mode == 'L' else 256)
+    if colors is not None:
+        try:
+            palette = _exact_palette(img, [color for _, color in colors])
+            if palette.convert(img.mode).tobytes() == img.tobytes():
+                img = palette
+        except (KeyError, ValueError) as e:
+            print(f"Palette reduction failed: {str(e)}")
+    if img is not original and img.convert(original.mode).tobytes() != original.tobytes():
+        return original
+    return img
+
+def _exact_palette(img, colors):
+    """img as a palette image of colors, every colour it has.
+
+    Median cut keeps every colour of an RGB image once there are no more
+    than it may use. Other modes go through an RGB key image with one key
+    per colour: gray as R=G=B, and with alpha the palette index of the RGB
+    part next to the alpha value.
+    """
+    def median_cut(rgb, count):
+        return rgb.quantize(count, Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+
+    gray = img.mode in ('L', 'LA')
+    full = {}
+    for color in colors:
+        color = color if isinstance(color, tuple) else (color,)
+        full[color] = (color[0],) * 3 + color[1:] if gray else color
+    if img.mode in ('RGBA', 'LA'):
+        rgb = img.convert('RGB')
+        index = median_cut(rgb, len(rgb.getcolors(256)))
+        rgb_index = {tuple(index.getpalette()[i * 3:i * 3 + 3]): i for i in range(len(index.getpalette()) // 3)}
+        alpha = img.getchannel('A')
+        key = Image.merge('RGB', [Image.frombytes('L', img.size, index.tobytes()), alpha, alpha])
+        keys = {(rgb_index[color[:3]], color[3], color[3]): color for color in full.values()}
+    else:
+        key = img.convert('RGB') if gray else img
+        keys = {color: color for color in full.values()}
+    palette = median_cut(key, len(keys))
+    entries = palette.getpalette()
+    palette.putpalette([value for i in range(len(entries) // 3) for value in keys[tuple(entries[i * 3:i * 3 + 3])]],
+                       'RGBA' if img.mode in ('RGBA', 'LA') else 'RGB')
+    return palette
+
+def _quantize_png(img, quality):
+    """Lossy palette version of an RGB or RGBA image, None for other modes.
+
+    quality 80 and up keeps 256 colours, lower qualities fewer.
+    """
+    if img.mode not in ('RGB', 'RGBA') or 'transparency' in img.info:
+        return None
+    colors = max(16, min(256, quality * 256 // 80))
+    method = Image.Quantize.LIBIMAGEQUANT if features.check_feature('libimagequant') else Image.Quantize.FASTOCTREE
+    return img.quantize(colors, method, dither=Image.Dither.FLOYDSTEINBERG)
+
+def atomic_write(path, data, like=None):
+    """Write bytes or str to path without ever leaving it half-written, see _AtomicOutput"""
+    with _AtomicOutput(path, like) as out:
+        with open(out.tmp, 'w' if isinstance(data, str) else 'wb') as f:
+            f.write(data)
+        out.commit()
+
+def _init_image_worker():
+    """Create the compressor that a pool worker reuses for every image it gets"""
+    global _worker_compressor
+    _worker_compressor = MediaCompressor()
+
+def _compress_image_in_worker(input_path, output_path, quality, fingerprint=False, trace=False, data=None, defer_write=False,
+                              lossy_png=False, pre_skip=False):
+    """Compress one image inside a pool worker.
+
+    Progress callbacks can't cross the process boundary, so the events are
+    collected and returned together with the details of this file, and with
+    trace its spans, for the parent to replay and record. data,
+    defer_write, lossy_png and pre_skip are passed on to compress_image.
+    """
+    start = time.perf_counter()
+    compressor = _worker_compressor
+    compressor.tracer = Tracer() if trace else None
+    events = []
+    details = {}
+    with compressor._span('file', file=Path(input_path).name):
+        if fingerprint:
+            with compressor._span('fingerprint', file=Path(input_path).name):
+                details['fingerprint'] = ResultCache.fingerprint(input_path, data)
+        result = compressor.compress_image(input_path, output_path, quality, events.append, details,
+                                           pre_skip, data=data, defer_write=defer_write, lossy_png=lossy_png)
+    spans = compressor.tracer.spans if trace else None
+    return result, events, details, spans, time.perf_counter() - start
+
+class _NullSpan:
+    """Stands in for a Tracer span while tracing is off"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ('spans', 'name', 'args', 'start')
+
+    def __init__(self, spans, name, args):
+        self.spans = spans
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        # list.append is atomic, worker threads record without a lock. Threads
+        # are told apart by name, idents are reused once a thread has exited.
+        self.spans.append((self.name, self.start, end, os.getpid(), threading.current_thread().name, self.args))
+        return False
+
+class Tracer:
+    """Timed spans per stage, file and thread, saved as a Chrome trace.
+
+    Pass one to compress_directory and open the saved file in
+    chrome://tracing or https://ui.perfetto.dev. Worker processes record
+    into their own tracer and the parent merges their spans with add().
+    Timestamps come from time.perf_counter, which is system-wide on the
+    platforms we support, so spans of different processes line up.
+    """
 
-class MediaCompressor:
     def __init__(self):
+        self.spans = []
+
+    def span(self, name, **args):
+        return _Span(self.spans, name, args)
+
+    def add(self, spans):
+        self.spans.extend(spans)
+
+    def to_chrome_trace(self):
+        spans = list(self.spans)
+        origin = min((span[1] for span in spans), default=0)
+        events = []
+        threads = {}
+        for name, start, end, pid, thread_name, args in spans:
+            tid = threads.setdefault((pid, thread_name), len(threads) + 1)
+            events.append({
+                'name': name, 'cat': 'compressit', 'ph': 'X',
+                'ts': (start - origin) * 1e6, 'dur': (end - start) * 1e6,
+                'pid': pid, 'tid': tid, 'args': args
+            })
+        for (pid, thread_name), tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        atomic_write(path, json.dumps(self.to_chrome_trace()))
+
+class FileResult(NamedTuple):
+    """Outcome of one file of a compress_directory run.
+
+    outcome is 'compressed', 'skipped', 'cached' or 'error'. Sizes, format
+    and encoder are None where they don't apply, e.g. output_bytes of a
+    skipped file or encoder of an image. probe is the ffprobe metadata of a
+    video, see MediaCompressor.probe_video.
+    """
+    path: Path
+    kind: str
+    outcome: str
+    input_bytes: Optional[int]
+    output_bytes: Optional[int]
+    output_path: Optional[Path]
+    format: Optional[str]
+    encoder: Optional[str]
+    seconds: Optional[float]
+    reason: Optional[str]
+    probe: Optional[dict] = None
+
+    @classmethod
+    def from_details(cls, path, kind, details):
+        output_path = details.get('output_path')
+        return cls(
+            path=Path(path),
+            kind=kind,
+            outcome=details.get('outcome', 'error'),
+            input_bytes=details.get('input_bytes'),
+            output_bytes=details.get('output_bytes'),
+            output_path=Path(output_path) if output_path else None,
+            format=details.get('format'),
+            encoder=details.get('encoder'),
+            seconds=details.get('seconds'),
+            reason=details.get('reason'),
+            probe=details.get('probe')
+        )
+
+    @property
+    def bytes_saved(self):
+        if self.outcome != 'compressed':
+            return 0
+        return self.input_bytes - self.output_bytes
+
+    def to_dict(self):
+        """Plain dict with paths as strings, for JSON and CSV"""
+        row = self._asdict()
+        row['path'] = str(self.path)
+        row['output_path'] = str(self.output_path) if self.output_path else None
+        return row
+
+class CompressedImage(NamedTuple):
+    """Result of MediaCompressor.compress_image_bytes.
+
+    data holds the compressed image and is None unless outcome is
+    'compressed'; a skipped image is best kept as it was.
+    """
+    outcome: str
+    data: Optional[bytes]
+    format: Optional[str]
+    input_bytes: Optional[int]
+    output_bytes: Optional[int]
+    seconds: Optional[float]
+    reason: Optional[str]
+
+class Rendition(NamedTuple):
+    """One output of MediaCompressor.compress_renditions.
+
+    max_side is the longest side in pixels, None keeps the full size;
+    nothing is scaled up. format ('JPEG', 'PNG', 'WEBP', 'HEIF') and quality
+    default to the image's own format and the quality of the call.
+    """
+    name: str
+    max_side: Optional[int] = None
+    format: Optional[str] = None
+    quality: Optional[int] = None
+
+class ResultCache:
+    """SQLite manifest of files handled by earlier runs, so re-runs can skip them.
+
+    Rows are keyed by path and the compression settings and remember the
+    size, mtime and content hash the file had. A lookup is a stat and one
+    primary key query; the file is only hashed again when its mtime moved
+    but its size did not.
+    """
+    COMMIT_EVERY = 100
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " path TEXT NOT NULL,"
+            " settings TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " mtime_ns INTEGER NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " outcome TEXT NOT NULL,"
+            " output_path TEXT,"
+            " PRIMARY KEY (path, settings))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def settings_key(quality, codec=None, use_hardware=None, lossy_png=False, pre_skip=False):
+        """Settings that change the result; images only depend on the quality, lossy_png and pre_skip"""
+        if codec is None:
+            return f"quality={quality}" + (";lossy_png=1" if lossy_png else "") + (";pre_skip=1" if pre_skip else "")
+        return f"quality={quality};codec={codec};hw={int(bool(use_hardware))}"
+
+    @staticmethod
+    def fingerprint(path, data=None):
+        """Return (size, mtime_ns, blake2b hex digest) of a file
+
+        If its content was already read, pass it as data to hash that instead
+        of reading the file again.
+        """
+        st = os.stat(path)
+        digest = hashlib.blake2b(digest_size=16)
+        if data is not None:
+            digest.update(data)
+            return len(data), st.st_mtime_ns, digest.hexdigest()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return st.st_size, st.st_mtime_ns, digest.hexdigest()
+
+    def lookup(self, path, settings, output_path=None):
+        """Return the stored outcome if the file is unchanged, otherwise None
+
+        With output_path, the file the output would be written to, a
+        compressed file only counts if it was written there, the suffix
+        aside (images can change format).
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, hash, outcome, output_path FROM results WHERE path = ? AND settings = ?",
+                (str(path), settings)
+            ).fetchone()
+        if row is None:
+            return None
+
+        size, mtime_ns, content_hash, outcome, stored_output = row
+        if size != st.st_size:
+            return None
+        if mtime_ns != st.st_mtime_ns:
+            # Touched but maybe not modified, let the content decide
+            if self.fingerprint(path)[2] != content_hash:
+                return None
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE results SET mtime_ns = ? WHERE path = ? AND settings = ?",
+                    (st.st_mtime_ns, str(path), settings)
+                )
+        if outcome == 'compressed':
+            if not (stored_output and os.path.exists(stored_output)):
+                return None
+            if output_path is not None and Path(stored_output).with_suffix('') != Path(output_path).with_suffix(''):
+                return None
+        return outcome
+
+    def store(self, path, settings, outcome, fingerprint, output_path=None):
+        size, mtime_ns, content_hash = fingerprint
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(path), settings, size, mtime_ns, content_hash, outcome,
+                 str(output_path) if output_path else None)
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self.COMMIT_EVERY:
+                self._conn.commit()
+                self._uncommitted = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+class RunJournal:
+    """Append-only log of one compress_directory run so it can be resumed.
+
+    Every line is a JSON object: the run's settings first, then each file
+    as it is found (with its size), started and done, and a final entry once
+    the run got through everything. Lines are flushed as they are written,
+    which survives the process being killed, and fsynced every SYNC_EVERY
+    lines or SYNC_SECONDS, so a power loss costs at most that much redone
+    work. A torn last line is cut off on load.
+
+    After a complete scan a resumed run over the same inputs can take its
+    remaining files straight from the journal, without walking the tree
+    again.
+    """
+    SYNC_EVERY = 256
+    SYNC_SECONDS = 2.0
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._load()
+
+    def _load(self):
+        self.settings = None
+        self.found = {}
+        self.started = set()
+        self.done = set()
+        self.scanned = False
+        self.finished = False
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            good = 0
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                good += len(line)
+                if 'run' in entry:
+                    self.settings = entry['run']
+                elif 'found' in entry:
+                    self.found[entry['found']] = entry['size']
+                elif 'start' in entry:
+                    self.started.add(entry['start'])
+                elif 'done' in entry:
+                    self.done.add(entry['done'])
+                elif 'scanned' in entry:
+                    self.scanned = True
+                elif 'finished' in entry:
+                    self.finished = True
+        if good < self.path.stat().st_size:
+            print(f"Dropping the incomplete last entry of {self.path}")
+            os.truncate(self.path, good)
+
+    def resume(self, settings):
+        """Continue the logged run if it had these settings and didn't finish, else start a new one.
+
+        Returns True when resuming.
+        """
+        settings = json.loads(json.dumps(settings))
+        resuming = self.settings == settings and not self.finished
+        if resuming:
+            self._file = open(self.path, 'a')
+        else:
+            self._file = open(self.path, 'w')
+            self.settings = settings
+            self.found, self.started, self.done = {}, set(), set()
+            self.scanned = self.finished = False
+            self.record(run=settings)
+            self.sync()
+        return resuming
+
+    def interrupted(self):
+        """Files that were started but not done, their outputs may have been half-written"""
+        return self.started - self.done
+
+    def remaining(self):
+        """(path, size) of every file found but not done yet, in the order found"""
+        return [(Path(path), size) for path, size in self.found.items() if path not in self.done]
+
+    def record(self, **entry):
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.SYNC_EVERY or time.monotonic() - self._last_sync >= self.SYNC_SECONDS:
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+class _Lane:
+    """One kind of work in compress_directory with its own worker count.
+
+    Files wait in a max-heap on their size so the largest ones start first,
+    and at most `workers` of them are handed to the executor at a time.
+    """
+    def __init__(self, name, workers, executor):
+        self.name = name
+        self.workers = workers
+        self.executor = executor
+        self.pending = []
+        self.running = 0
+        self.files = 0
+        self.busy_time = 0.0
+
+    def push(self, file_path, size, order):
+        heapq.heappush(self.pending, (-size, order, file_path))
+
+    def pop(self):
+        return heapq.heappop(self.pending)[2]
+
+    def peek(self):
+        return self.pending[0][2]
+
+    def peek_size(self):
+        return -self.pending[0][0]
+
+    def has_capacity(self):
+        return bool(self.pending) and self.running < self.workers
+
+    def stats(self, elapsed):
+        capacity = elapsed * self.workers
+        return {
+            'workers': self.workers,
+            'files': self.files,
+            'busy_time': self.busy_time,
+            'utilization': (self.busy_time / capacity * 100) if capacity > 0 else 0
+        }
+
+class _Stage:
+    """Bounded I/O stage of compress_directory, reading ahead or writing behind.
+
+    Holds at most depth files and budget bytes at a time. A file larger than
+    the whole budget is still admitted when the stage is empty, so it can't
+    stall the run.
+    """
+    def __init__(self, name, depth, budget):
+        self.name = name
+        self.depth = depth
+        self.budget = budget
+        self.held = 0
+        self.held_bytes = 0
+        self.peak_bytes = 0
+        self.files = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+
+    def admits(self, size):
+        if self.held == 0:
+            return self.depth > 0
+        return self.held < self.depth and self.held_bytes + size <= self.budget
+
+    def acquire(self, size):
+        self.held += 1
+        self.held_bytes += size
+        self.peak_bytes = max(self.peak_bytes, self.held_bytes)
+
+    def release(self, size, busy):
+        self.held -= 1
+        self.held_bytes -= size
+        self.files += 1
+        self.bytes += size
+        self.busy_time += busy
+
+    def stats(self, elapsed):
+        return {
+            'depth': self.depth,
+            'budget': self.budget,
+            'files': self.files,
+            'bytes': self.bytes,
+            'peak_bytes': self.peak_bytes,
+            'busy_time': self.busy_time,
+            'mb_per_second': (self.bytes / self.busy_time / (1024 * 1024)) if self.busy_time > 0 else 0
+        }
+
+def _cpu_sample():
+    """(busy, iowait, total) CPU time of the whole system, None where /proc/stat is missing"""
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(value) for value in f.readline().split()[1:9]]
+    except (OSError, ValueError):
+        return None
+    idle, iowait = fields[3], fields[4]
+    total = sum(fields)
+    return total - idle - iowait, iowait, total
+
+class _Autotuner:
+    """Moves a lane's worker count to where its throughput peaks.
+
+    Every window (at least `window` seconds and one finished file per
+    worker) it compares the input bytes per second with the previous
+    window and climbs: it keeps stepping in the same direction while
+    throughput improves by more than `threshold`, goes back a step when it
+    drops or adding workers made no difference, and then holds for `settle`
+    windows before probing upwards again. It doesn't add workers while the
+    CPUs are saturated and nothing waits on I/O. CPU and I/O wait come from
+    /proc/stat, elsewhere from this process's CPU time without I/O wait.
+    Every decision is kept in `decisions` with the numbers behind it.
+    """
+    def __init__(self, lane, minimum, maximum, window=2.0, threshold=0.05, settle=3):
+        self.lane = lane
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.threshold = threshold
+        self.settle = settle
+        self.decisions = []
+        self._cpus = os.cpu_count() or 1
+        self._run_start = time.perf_counter()
+        self._previous = None
+        self._direction = 1
+        self._hold = 0
+        self._begin_window()
+
+    def _sample(self):
+        sample = _cpu_sample()
+        if sample is not None:
+            return sample
+        times = os.times()
+        return times.user + times.system, None, time.perf_counter() * self._cpus
+
+    def _begin_window(self):
+        self._start = time.perf_counter()
+        self._cpu = self._sample()
+        self._bytes = 0
+        self._files = 0
+
+    def add(self, input_bytes):
+        self._files += 1
+        self._bytes += input_bytes
+
+    def update(self):
+        """Close the window if it is complete and adjust the lane, returns the decision or None"""
+        elapsed = time.perf_counter() - self._start
+        if elapsed < self.window or self._files < self.lane.workers:
+            return None
+        sample = self._sample()
+        total = sample[2] - self._cpu[2]
+        cpu = (sample[0] - self._cpu[0]) / total if total > 0 else 0.0
+        iowait = (sample[1] - self._cpu[1]) / total if total > 0 and sample[1] is not None else None
+        throughput = self._bytes / elapsed
+        workers = self.lane.workers
+        target, reason = self._decide(workers, throughput, cpu, iowait or 0.0)
+        self.lane.workers = target
+        decision = {
+            'time': round(time.perf_counter() - self._run_start, 3),
+            'workers_before': workers,
+            'workers': target,
+            'mb_per_second': round(throughput / (1024 * 1024), 3),
+            'cpu': round(cpu * 100, 1),
+            'iowait': round(iowait * 100, 1) if iowait is not None else None,
+            'reason': reason
+        }
+        self.decisions.append(decision)
+        if target != workers:
+            print(f"Autotune: {workers} -> {target} {self.lane.name} workers ({reason})")
+        self._begin_window()
+        return decision
+
+    def _decide(self, workers, throughput, cpu, iowait):
+        saturated = cpu >= 0.95 and iowait < 0.05
+        previous = self._previous
+        self._previous = (workers, throughput)
+        if self._hold:
+            self._hold -= 1
+            if not self._hold:
+                # Probe again, the mix of files may have changed
+                self._previous = None
+            return workers, "settled"
+        step = max(1, workers // 4)
+
+        if previous is None or previous[0] == workers:
+            self._direction = 1 if not saturated else -1
+            reason = f"probing, CPU {cpu:.0%}, I/O wait {iowait:.0%}"
+        else:
+            gain = throughput / previous[1] - 1 if previous[1] > 0 else 0.0
+            if gain > self.threshold:
+                reason = f"throughput {gain:+.0%} at {workers} workers, continuing"
+            elif gain < -self.threshold or self._direction > 0:
+                # Worse, or more workers bought nothing: step back and stay there
+                self._direction = -self._direction
+                self._hold = self.settle
+                target = min(self.maximum, max(self.minimum, previous[0]))
+                self._previous = (target, previous[1])
+                return target, f"throughput {gain:+.0%} at {workers} workers, back to {target}"
+            else:
+                # Fewer workers did as well, keep them
+                self._hold = self.settle
+                return workers, f"throughput {gain:+.0%} with fewer workers, keeping {workers}"
+
+        if self._direction > 0 and saturated:
+            self._hold = self.settle
+            return workers, f"CPU saturated ({cpu:.0%}), I/O wait {iowait:.0%}"
+        target = min(self.maximum, max(self.minimum, workers + self._direction * step))
+        if target == workers:
+            self._hold = self.settle
+            return workers, f"already at the {'maximum' if self._direction > 0 else 'minimum'} worker count"
+        return target, reason
+
+class _DirectoryRun:
+    """One MediaCompressor.compress_directory call.
+
+    A scanner thread feeds found files into a queue; everything else runs
+    on the thread calling run(), which hands files to the image and video
+    _Lane and the read and write _Stage and handles their futures.
+    """
+    def __init__(self, compressor, media_files, output_dir, *, quality, thread_count, progress_callback,
+                 cancel_check, use_hardware, codec, replace_files, engine, video_workers, cache, scan_queue_size,
+                 layout, source_root, segment_workers, tracer, read_ahead, read_ahead_bytes, write_behind,
+                 write_behind_bytes, io_threads, journal, inputs, memory_budget, autotune, lossy_png,
+                 pre_skip_images):
+        self.compressor = compressor
+        self.media_files = media_files
+        self.output_dir = Path(output_dir)
+        self.quality = quality
+        self.thread_count = thread_count
+        self.progress_callback = progress_callback
+        self.cancel_check = cancel_check
+        self.use_hardware = use_hardware
+        self.codec = codec
+        self.replace_files = replace_files
+        self.engine = engine
+        self.video_workers = video_workers
+        self.scan_queue_size = scan_queue_size
+        self.layout = layout
+        self.source_root = source_root
+        self.segment_workers = segment_workers
+        self.tracer = tracer
+        self.io_threads = io_threads
+        self.inputs = inputs
+        self.memory_budget = memory_budget
+        self.autotune = autotune
+        self.lossy_png = lossy_png
+        self.pre_skip_images = pre_skip_images
+        self._span = compressor._span
+        self.image_formats = compressor.supported_image_formats
+
+        self.owns_cache = cache is not None and not isinstance(cache, ResultCache)
+        self.cache = ResultCache(cache) if self.owns_cache else cache
+        self.owns_journal = journal is not None and not isinstance(journal, RunJournal)
+        self.journal = RunJournal(journal) if self.owns_journal else journal
+        self.settings = {
+            'image': ResultCache.settings_key(quality, lossy_png=lossy_png, pre_skip=pre_skip_images),
+            'video': ResultCache.settings_key(quality, codec, use_hardware)
+        }
+
+        self.total_files = len(media_files) if hasattr(media_files, '__len__') else None
+        self.files_found = 0
+        self.files_done = 0
+        self.successful = 0
+        self.scan_done = threading.Event()
+        self.found_queue = queue.Queue(maxsize=scan_queue_size)
+        self.stop_scan = threading.Event()
+        self.scan_complete = False
+        self.found_files = self.sized(media_files)
+
+        self.read_stage = _Stage('read', 2 * thread_count if read_ahead is None else read_ahead, read_ahead_bytes)
+        self.write_stage = _Stage('write', 2 * thread_count if write_behind is None else write_behind,
+                                  write_behind_bytes)
+        # Admits image encodes by their estimated decoded size, filled in by the scanner
+        self.memory_stage = _Stage('memory', thread_count, memory_budget) if memory_budget else None
+        self.decode_bytes = {}
+        # Images that were read ahead, waiting for an encoder
+        self.ready = deque()
+        # Encoded images waiting for room in the write-behind stage
+        self.pending_writes = deque()
+        # Output claim (see _output_claim) -> the input writing it, photo.jpg
+        # and photo.heic or files of one name in different directories of
+        # the flat layout would overwrite each other otherwise
+        self.output_owners = {}
+
+        # Set up by run()
+        self.image_pool = None
+        self.write_threads = None
+        self.read_threads = None
+        self.lanes = {}
+        self.tuner = None
+        # future -> (handler, *args), the handler is called with the future once it is done
+        self.running = {}
+        self.order = 0
+        self.queue_drained = False
+
+    def sized(self, files):
+        """Pair every file with its size"""
+        for f in files:
+            f = Path(f)
+            try:
+                with self._span('scan_stat', file=f.name):
+                    size = f.stat().st_size
+            except OSError:
+                size = 0
+            yield f, size
+
+    def scan(self):
+        """Feed (path, size) pairs from found_files into found_queue, runs on the scanner thread"""
+        journal = self.journal
+        try:
+            for f, size in self.found_files:
+                if self.stop_scan.is_set():
+                    break
+                if self.memory_stage is not None and f.suffix.lower() in self.image_formats:
+                    with self._span('header', file=f.name):
+                        self.decode_bytes[f] = _decoded_image_bytes(f) or 0
+                if journal is not None and str(f) not in journal.found:
+                    journal.record(found=str(f), size=size)
+                self.found_queue.put((f, size))
+                self.files_found += 1
+            else:
+                self.scan_complete = True
+                if journal is not None and not journal.scanned:
+                    journal.record(scanned=True)
+        except Exception as e:
+            print(f"Error scanning for files: {e}")
+        finally:
+            self.scan_done.set()
+            self.found_queue.put(None)
+
+    def resume(self):
+        """Pick up where an earlier run with the same journal and settings stopped"""
+        journal = self.journal
+        run_settings = {
+            'quality': self.quality, 'codec': self.codec, 'use_hardware': self.use_hardware,
+            'replace_files': self.replace_files, 'layout': self.layout, 'output_dir': str(self.output_dir),
+            'source_root': str(self.source_root) if self.source_root else None,
+            'lossy_png': self.lossy_png, 'pre_skip_images': self.pre_skip_images, 'inputs': self.inputs
+        }
+        with self._span('journal_resume'):
+            if not journal.resume(run_settings):
+                return
+            removed = sum(_remove_temp_files(self.output_path_for(Path(path)).parent)
+                          for path in journal.interrupted())
+            media_files = self.media_files
+            if hasattr(media_files, '__len__'):
+                media_files = [f for f in media_files if str(Path(f)) not in journal.done]
+                self.found_files = self.sized(media_files)
+            elif journal.scanned and self.inputs is not None:
+                # The same inputs were already walked completely, skip the walk
+                media_files = journal.remaining()
+                self.found_files = iter(media_files)
+            else:
+                media_files = (f for f in media_files if str(Path(f)) not in journal.done)
+                self.found_files = self.sized(media_files)
+            self.total_files = len(media_files) if isinstance(media_files, list) else None
+            print(f"Resuming from {journal.path}: {len(journal.done)} files already done, "
+                  f"{removed} temp files removed")
+
+    def file_done(self, file_path, kind, details):
+        """Record a finished file"""
+        record = FileResult.from_details(file_path, kind, details)
+        self.compressor._add_result(record)
+        if self.journal is not None and record.outcome != 'error':
+            self.journal.record(done=str(file_path), outcome=record.outcome)
+        self.files_done += 1
+        if record.outcome == 'compressed':
+            self.successful += 1
+
+        if self.progress_callback:
+            total = self.total_files
+            if total is None and self.scan_done.is_set():
+                total = self.files_found
+            self.progress_callback({
+                'progress': (self.successful / total * 100) if total else (0 if total == 0 else None),
+                'files_processed': self.successful,
+                'total_files': total,
+                'files_found': self.files_found,
+                'files_done': self.files_done,
+                'current_file': file_path.name,
+                'path': file_path,
+                'details': details,
+                'result': record
+            })
+
+    def output_path_for(self, file_path):
+        if self.replace_files:
+            return file_path
+        if self.layout == 'mirror':
+            output_path = self.output_dir / file_path.relative_to(self.source_root)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            return output_path
+        return self.output_dir / file_path.name
+
+    def process_single_file(self, file_path, data=None, defer_write=False):
+        """Compress one file on an executor thread, returns (result, details, seconds)"""
+        compressor = self.compressor
+        start = time.perf_counter()
+        with self._span('file', file=file_path.name):
+            output_path = self.output_path_for(file_path)
+            details = {}
+            if self.cache is not None:
+                with self._span('fingerprint', file=file_path.name):
+                    details['fingerprint'] = ResultCache.fingerprint(file_path, data)
+            if file_path.suffix.lower() in self.image_formats:
+                result = compressor.compress_image(file_path, output_path, self.quality, self.progress_callback,
+                                                   details, self.pre_skip_images, data=data,
+                                                   defer_write=defer_write, lossy_png=self.lossy_png)
+            else:
+                result = compressor.compress_video(file_path, output_path, self.quality, self.use_hardware,
+                                                   self.codec, self.progress_callback, details,
+                                                   segment_workers=self.segment_workers)
+        return result, details, time.perf_counter() - start
+
+    def read_file(self, file_path):
+        start = time.perf_counter()
+        with self._span('read', file=file_path.name):
+            data = file_path.read_bytes()
+        return data, time.perf_counter() - start
+
+    def write_file(self, file_path, output_path, buffer):
+        start = time.perf_counter()
+        with self._span('write', file=output_path.name):
+            atomic_write(output_path, buffer.getbuffer(), like=file_path if self.replace_files else None)
+        return time.perf_counter() - start
+
+    def finish(self, file_path, lane, details):
+        # Errors are not remembered so the next run tries those files again
+        if self.cache is not None and details.get('outcome') in ('compressed', 'skipped'):
+            fingerprint = details['fingerprint']
+            if self.replace_files and details['outcome'] == 'compressed':
+                # The original is gone, remember the file that replaced it
+                with self._span('fingerprint', file=file_path.name):
+                    fingerprint = ResultCache.fingerprint(details['output_path'])
+            with self._span('cache_store', file=file_path.name):
+                self.cache.store(file_path, self.settings[lane.name], details['outcome'], fingerprint,
+                                 details.get('output_path'))
+        self.file_done(file_path, lane.name, details)
+
+    def collect(self, future, lane, file_path):
+        """Account for a finished encode, merging worker process results"""
+        lane.running -= 1
+        if lane.name == 'image' and self.memory_stage is not None:
+            self.memory_stage.release(self.decode_bytes.pop(file_path, 0), 0.0)
+        try:
+            if lane.executor is self.image_pool:
+                result, events, details, spans, busy = future.result()
+                if spans:
+                    self.tracer.add(spans)
+                if self.progress_callback:
+                    for event in events:
+                        self.progress_callback(event)
+            else:
+                result, details, busy = future.result()
+        except Exception as e:
+            print(f"Error processing {file_path}: {e}")
+            if self.progress_callback:
+                self.progress_callback('error')
+            self.file_done(file_path, lane.name, {'outcome': 'error', 'reason': str(e)})
+            return
+
+        lane.files += 1
+        lane.busy_time += busy
+        if self.tuner is not None and lane is self.tuner.lane:
+            self.tuner.add(details.get('input_bytes') or 0)
+        details['seconds'] = busy
+        buffer = details.pop('output_data', None)
+        if buffer is not None:
+            self.pending_writes.append((file_path, lane, details, buffer))
+            self.start_writes()
+        else:
+            self.finish(file_path, lane, details)
+
+    def read_done(self, future, file_path, size):
+        try:
+            data, busy = future.result()
+        except OSError as e:
+            # The encoder opens the file itself and reports the error
+            print(f"Error reading {file_path}: {e}")
+            data, busy = None, 0.0
+        self.ready.append((file_path, data, size, busy))
+
+    def write_done(self, future, file_path, lane, details, size):
+        try:
+            busy = future.result()
+        except OSError as e:
+            print(f"Error writing {details['output_path']}: {e}")
+            self.write_stage.release(size, 0.0)
+            for key in ('output_path', 'output_bytes', 'format'):
+                details.pop(key, None)
+            details.update(outcome='error', reason=str(e))
+            if self.progress_callback:
+                self.progress_callback('error')
+            self.file_done(file_path, lane.name, details)
+        else:
+            self.write_stage.release(size, busy)
+            details['seconds'] += busy
+            self.finish(file_path, lane, details)
+        self.start_writes()
+
+    def start_writes(self):
+        """Hand encoded images to the writers while the write-behind stage has room"""
+        while self.pending_writes:
+            size = self.pending_writes[0][3].getbuffer().nbytes
+            if not self.write_stage.admits(size):
+                return
+            file_path, lane, details, buffer = self.pending_writes.popleft()
+            self.write_stage.acquire(size)
+            future = self.write_threads.submit(self.write_file, file_path, details['output_path'], buffer)
+            self.running[future] = (self.write_done, file_path, lane, details, size)
+
+    def file_cached(self, file_path, kind, size):
+        self.decode_bytes.pop(file_path, None)
+        if self.progress_callback:
+            self.progress_callback({
+                'skipped': True,
+                'current_file': file_path.name,
+                'reason': 'unchanged since last run'
+            })
+        self.file_done(file_path, kind, {'outcome': 'cached', 'input_bytes': size,
+                                         'reason': 'unchanged since last run'})
+
+    def add_found(self, item):
+        """Route one scanned file to its lane, returns False at the end of the scan"""
+        if item is None:
+            self.queue_drained = True
+            return False
+        f, size = item
+        kind = 'image' if f.suffix.lower() in self.image_formats else 'video'
+        output_path = self.output_path_for(f)
+        owner = self.output_owners.setdefault(self.compressor._output_claim(f, output_path), f)
+        if owner != f:
+            print(f"Skipped {f} (same output name as {owner})")
+            self.file_done(f, kind, {'outcome': 'error', 'input_bytes': size,
+                                     'reason': f"same output name as {owner}"})
+            return True
+        if kind == 'video':
+            output_path = Path(_video_output_path(f, output_path))
+        with self._span('cache_lookup', file=f.name):
+            cached = self.cache is not None and self.cache.lookup(f, self.settings[kind], output_path)
+        if cached:
+            self.file_cached(f, kind, size)
+        else:
+            self.lanes[kind].push(f, size, self.order)
+            self.order += 1
+        return True
+
+    def take_found(self, block):
+        """Move scanned files into the lanes, keeping at most scan_queue_size waiting there"""
+        while (not self.queue_drained
+               and sum(len(lane.pending) for lane in self.lanes.values()) < self.scan_queue_size):
+            try:
+                item = self.found_queue.get(block=block, timeout=0.1 if block else None)
+            except queue.Empty:
+                return
+            block = False
+            if not self.add_found(item):
+                return
+
+    def start_encode(self, lane, f, data=None):
+        defer_write = lane.name == 'image' and self.write_stage.depth > 0
+        if self.journal is not None:
+            self.journal.record(start=str(f))
+        if lane.name == 'image' and self.memory_stage is not None:
+            self.memory_stage.acquire(self.decode_bytes.get(f, 0))
+        if lane.executor is self.image_pool:
+            args = (f, self.output_path_for(f), self.quality, self.cache is not None, self.tracer is not None, data,
+                    defer_write, self.lossy_png, self.pre_skip_images)
+            try:
+                future = self.image_pool.submit(_compress_image_in_worker, *args)
+            except concurrent.futures.BrokenExecutor:
+                # A worker died (OOM-killed, say), the files it had fail and the rest go to a new pool
+                print("An image worker process died, restarting the pool")
+                self.image_pool = lane.executor = self.compressor._get_image_pool(self.thread_count)
+                future = self.image_pool.submit(_compress_image_in_worker, *args)
+        else:
+            future = lane.executor.submit(self.process_single_file, f, data, defer_write)
+        lane.running += 1
+        self.running[future] = (self.collect, lane, f)
+
+    def memory_admits(self, f):
+        return self.memory_stage is None or self.memory_stage.admits(self.decode_bytes.get(f, 0))
+
+    def dispatch(self):
+        image_lane = self.lanes['image']
+        read_stage = self.read_stage
+        # Read ahead of the encoders, largest first like the lane itself
+        while image_lane.pending and read_stage.admits(image_lane.peek_size()):
+            size = image_lane.peek_size()
+            f = image_lane.pop()
+            read_stage.acquire(size)
+            self.running[self.read_threads.submit(self.read_file, f)] = (self.read_done, f, size)
+
+        for lane in self.lanes.values():
+            # Images that are encoded but can't be written yet hold back new encodes
+            if lane is image_lane and self.pending_writes:
+                continue
+            if lane is image_lane and read_stage.depth > 0:
+                while self.ready and lane.running < lane.workers and self.memory_admits(self.ready[0][0]):
+                    f, data, size, busy = self.ready.popleft()
+                    read_stage.release(size, busy)
+                    self.start_encode(lane, f, data)
+            else:
+                while lane.has_capacity() and (lane is not image_lane or self.memory_admits(lane.peek())):
+                    self.start_encode(lane, lane.pop())
+
+    def loop(self):
+        """Dispatch until every file is done or cancel_check says stop, returns True when all were done"""
+        while not (self.cancel_check and self.cancel_check()):
+            self.take_found(block=False)
+            self.dispatch()
+            if not self.running:
+                if self.queue_drained and not self.ready and not any(lane.pending for lane in self.lanes.values()):
+                    return True
+                # Idle until the scanner finds the next file
+                self.take_found(block=True)
+                continue
+
+            # Poll while the scan is running so newly found files reach idle workers
+            with self._span('wait'):
+                done, _ = concurrent.futures.wait(
+                    self.running,
+                    timeout=None if self.queue_drained else 0.1,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+            for future in done:
+                handler, *args = self.running.pop(future)
+                handler(future, *args)
+            if self.tuner is not None:
+                self.tuner.update()
+        return False
+
+    def run(self):
+        compressor = self.compressor
+        with compressor._results_lock:
+            compressor._results = []
+        compressor.tracer = self.tracer
+        start_time = time.perf_counter()
+        finished = False
+        try:
+            if self.journal is not None:
+                self.resume()
+
+            thread_count = self.thread_count
+            self.image_pool = compressor._get_image_pool(thread_count) if self.engine == 'process' else None
+            scanner = threading.Thread(target=self.scan, name='compressit-scanner', daemon=True)
+
+            with ThreadPoolExecutor(max_workers=thread_count) as image_threads, \
+                    ThreadPoolExecutor(max_workers=self.video_workers) as video_threads, \
+                    ThreadPoolExecutor(max_workers=self.io_threads, thread_name_prefix='compressit-read') as read_threads, \
+                    ThreadPoolExecutor(max_workers=self.io_threads, thread_name_prefix='compressit-write') as write_threads:
+                self.read_threads = read_threads
+                self.write_threads = write_threads
+                self.lanes = {
+                    'image': _Lane('image', thread_count, self.image_pool or image_threads),
+                    'video': _Lane('video', self.video_workers, video_threads)
+                }
+                if self.autotune:
+                    self.lanes['image'].workers = min(thread_count, os.cpu_count() or 1)
+                    self.tuner = _Autotuner(self.lanes['image'], 1, thread_count)
+
+                scanner.start()
+                try:
+                    finished = self.loop()
+                finally:
+                    # On cancel or an error stop handing out work, files already running are left to finish
+                    self.stop_scan.set()
+                    while not self.queue_drained and scanner.is_alive():
+                        try:
+                            if self.found_queue.get(timeout=0.1) is None:
+                                break
+                        except queue.Empty:
+                            pass
+        finally:
+            if self.owns_cache:
+                self.cache.close()
+            if self.journal is not None:
+                if finished and self.scan_complete:
+                    self.journal.record(finished=True)
+                if self.owns_journal:
+                    self.journal.close()
+                else:
+                    self.journal.sync()
+            compressor.tracer = None
+        return self.stats(time.perf_counter() - start_time)
+
+    def stats(self, elapsed):
+        stats = self.compressor._get_stats(self.total_files if self.total_files is not None else self.files_found)
+        stats['elapsed'] = elapsed
+        stats['lanes'] = {name: lane.stats(elapsed) for name, lane in self.lanes.items()}
+        stats['stages'] = {stage.name: stage.stats(elapsed) for stage in (self.read_stage, self.write_stage)}
+        stats['memory'] = {
+            'budget': self.memory_budget,
+            'peak_decode_bytes': self.memory_stage.peak_bytes if self.memory_stage is not None else None,
+            'peak_rss': _peak_rss()
+        }
+        tuner = self.tuner
+        stats['autotune'] = {'workers': tuner.lane.workers, 'decisions': tuner.decisions} if tuner is not None else None
+        return stats
+
+class MediaCompressor:
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, encoder_cache_file=None):
         self.supported_image_formats = {'.jpg', '.jpeg', '.png', '.webp', '.heic'}
-        self.supported_video_formats = {'.mov', '.mp4', '.avi', '.mkv', '.wmv', '.flv'}
+        self.supported_video_formats = {'.mov', '.mp4', '.avi', '.mkv', '.wmv', '.flv', '.webm'}
         self.supported_formats = self.supported_image_formats.union(self.supported_video_formats)
-        self.hw_encoders = self._detect_hw_encoders()
+        self.ffmpeg_path = ffmpeg_path or shutil.which('ffmpeg') or 'ffmpeg'
+        self.ffprobe_path = ffprobe_path or shutil.which('ffprobe') or 'ffprobe'
+        self.encoder_cache_file = Path(encoder_cache_file or Path.home() / '.compressit_encoders.json')
+        # Detected on first use, see hw_encoders
+        self._hw_encoders = None
+        self._hw_encoders_lock = threading.Lock()
         # Register HEIF opener for .heic files
         pillow_heif.register_heif_opener()
-        self.compression_stats = {
-            'original_size': 0,
-            'compressed_size': 0,
-            'files_processed': 0,
-            'files_skipped': 0
+        # FileResults of the last compress_directory run, see results
+        self._results = []
+        self._results_lock = threading.Lock()
+        # Tracer of the current run, None unless tracing, see _span
+        self.tracer = None
+        # Image process pool, created on first use and kept for later runs
+        self._image_pool = None
+        self._image_pool_size = 0
+        # Speed of the last HEIF encode, used to keep PNGs within their time budget
+        self._heif_seconds_per_pixel = _HEIF_SECONDS_PER_PIXEL
+
+    def _output_claim(self, input_path, output_path):
+        """The output two inputs must not share: images can change their suffix, videos get .mp4 appended"""
+        if Path(input_path).suffix.lower() in self.supported_image_formats:
+            return Path(output_path).with_suffix('')
+        return Path(_video_output_path(input_path, output_path))
+
+    def _span(self, name, **args):
+        """Timed span on the current tracer, a shared no-op while tracing is off"""
+        tracer = self.tracer
+        if tracer is None:
+            return _NULL_SPAN
+        return tracer.span(name, **args)
+
+    @property
+    def results(self):
+        """Snapshot of the FileResults of the current or last compress_directory run"""
+        with self._results_lock:
+            return tuple(self._results)
+
+    def _add_result(self, result):
+        with self._results_lock:
+            self._results.append(result)
+
+    @property
+    def compression_stats(self):
+        """Totals of the current or last run, derived from its results"""
+        results = self.results
+        compressed = [r for r in results if r.outcome == 'compressed']
+        return {
+            'original_size': sum(r.input_bytes for r in compressed),
+            'compressed_size': sum(r.output_bytes for r in compressed),
+            'files_processed': len(compressed),
+            'files_skipped': sum(1 for r in results if r.outcome == 'skipped'),
+            'files_cached': sum(1 for r in results if r.outcome == 'cached'),
+            'files_failed': sum(1 for r in results if r.outcome == 'error')
         }
 
+    def export_results(self, path):
+        """Write the results of the last run to path as CSV or JSON, chosen by its suffix"""
+        path = Path(path)
+        rows = [result.to_dict() for result in self.results]
+        if path.suffix.lower() == '.csv':
+            with _AtomicOutput(path) as out:
+                with open(out.tmp, 'w', newline='') as f:
+                    writer = csv.DictWriter(f, fieldnames=FileResult._fields)
+                    writer.writeheader()
+                    for row in rows:
+                        # A nested dict doesn't fit a cell, it goes in as JSON
+                        if row['probe'] is not None:
+                            row['probe'] = json.dumps(row['probe'])
+                        writer.writerow(row)
+                out.commit()
+        elif path.suffix.lower() == '.json':
+            atomic_write(path, json.dumps(rows, indent=2))
+        else:
+            raise ValueError(f"Unsupported report format: {path.suffix}")
+
+    def _get_image_pool(self, workers):
+        """Return the image process pool, (re)starting it if the size changed or a worker died"""
+        pool = self._image_pool
+        # A pool that lost a worker refuses all further work
+        if pool is None or self._image_pool_size != workers or getattr(pool, '_broken', False):
+            # Imported here, it costs several ms at import time and most runs use threads
+            from concurrent.futures import ProcessPoolExecutor
+            self.close()
+            self._image_pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_image_worker)
+            self._image_pool_size = workers
+        return self._image_pool
+
+    def close(self):
+        """Shut down the image worker processes"""
+        if self._image_pool is not None:
+            self._image_pool.shutdown(wait=True)
+            self._image_pool = None
+            self._image_pool_size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def hw_encoders(self) -> Dict[str, str]:
+        """Working hardware encoder per codec ('h264'/'h265'), detected once"""
+        if self._hw_encoders is None:
+            # Concurrent first callers wait for one detection instead of each running the trial encodes
+            with self._hw_encoders_lock:
+                if self._hw_encoders is None:
+                    self._hw_encoders = self._detect_hw_encoders()
+        return self._hw_encoders
+
     def _detect_hw_encoders(self) -> Dict[str, str]:
-        """Detect available hardware encoders"""
+        """Detect hardware encoders that actually work on this machine.
+
+        ffmpeg lists encoders it was built with whether or not a GPU is
+        present, so every listed candidate gets a one frame trial encode. The
+        result is cached on disk per ffmpeg binary and its mtime, a different
+        or updated ffmpeg is probed again.
+        """
+        try:
+            mtime_ns = os.stat(self.ffmpeg_path).st_mtime_ns
+        except OSError:
+            return {}
+
+        try:
+            with open(self.encoder_cache_file) as f:
+                cached = json.load(f).get(self.ffmpeg_path)
+            if cached and cached['mtime_ns'] == mtime_ns:
+                return cached['encoders']
+        except (OSError, ValueError, KeyError):
+            pass
+
         encoders = {}
-        
-        # Check for NVIDIA NVENC
-        if shutil.which('ffmpeg'):
-            try:
-                result = subprocess.run(['ffmpeg', '-encoders'], capture_output=True, text=True)
-                if 'hevc_nvenc' in result.stdout:
-                    encoders['nvidia'] = 'hevc_nvenc'
-                if 'h264_nvenc' in result.stdout:
-                    encoders['nvidia_h264'] = 'h264_nvenc'
-                if 'hevc_qsv' in result.stdout:
-                    encoders['intel'] = 'hevc_qsv'
-                if 'hevc_videotoolbox' in result.stdout:
-                    encoders['mac'] = 'hevc_videotoolbox'
-                if 'hevc_amf' in result.stdout:
-                    encoders['amd'] = 'hevc_amf'
-            except Exception:
-                pass
+        try:
+            result = subprocess.run([self.ffmpeg_path, '-hide_banner', '-encoders'],
+                                    capture_output=True, text=True, timeout=30)
+            available = {line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 1}
+        except (OSError, subprocess.SubprocessError):
+            return {}
+        for codec, candidates in _HW_ENCODERS.items():
+            for encoder in candidates:
+                if encoder in available and self._trial_encode(encoder):
+                    encoders[codec] = encoder
+                    break
+
+        self._save_encoder_cache(mtime_ns, encoders)
         return encoders
 
+    def _trial_encode(self, encoder):
+        """Encode one synthetic frame to see if the encoder initializes"""
+        args = [self.ffmpeg_path, '-hide_banner', '-nostdin', '-loglevel', 'error']
+        if encoder.endswith('_vaapi'):
+            args += ['-vaapi_device', _VAAPI_DEVICE]
+        args += ['-f', 'lavfi', '-i', 'color=black:size=256x256:duration=0.1', '-frames:v', '1']
+        for key, value in self._hw_encoder_options(encoder, 25).items():
+            args += [f'-{key}', str(value)]
+        args += ['-f', 'null', '-']
+        try:
+            return subprocess.run(args, capture_output=True, timeout=30).returncode == 0
+        except (OSError, subprocess.SubprocessError):
+            return False
+
+    def _save_encoder_cache(self, mtime_ns, encoders):
+        try:
+            with open(self.encoder_cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        cache[self.ffmpeg_path] = {'mtime_ns': mtime_ns, 'encoders': encoders}
+        try:
+            atomic_write(self.encoder_cache_file, json.dumps(cache, indent=4))
+        except OSError as e:
+            print(f"Could not save encoder cache: {e}")
+
+    @staticmethod
+    def _hw_encoder_options(encoder, hw_quality):
+        """ffmpeg output options for a hardware encoder at a 0-51 quality level"""
+        vendor = encoder.split('_', 1)[1]
+        if vendor == 'nvenc':
+            return {'vcodec': encoder, 'preset': 'p4', 'rc': 'vbr', 'cq': hw_quality, 'gpu': '0'}
+        if vendor == 'qsv':
+            return {'vcodec': encoder, 'preset': 'medium', 'global_quality': hw_quality}
+        if vendor == 'amf':
+            return {'vcodec': encoder, 'rc': 'cqp', 'qp_i': hw_quality, 'qp_p': hw_quality}
+        if vendor == 'videotoolbox':
+            # VideoToolbox takes 1-100 with higher meaning better
+            return {'vcodec': encoder, 'q:v': max(1, 100 - hw_quality * 100 // 51)}
+        if vendor == 'vaapi':
+            return {'vcodec': encoder, 'vf': 'format=nv12,hwupload', 'rc_mode': 'CQP', 'qp': hw_quality}
+        return {'vcodec': encoder}
+
+    def iter_media(self, root_dir, formats=None, exclude_names=('compressed',), exclude_paths=()) -> Iterator[Path]:
+        """Yield supported media files below root_dir as they are found.
+
+        The tree is walked with os.scandir on an explicit stack so nothing is
+        collected up front. Directories named in exclude_names or located at
+        one of exclude_paths are not entered, which keeps the output of
+        earlier runs from being picked up again. Temp files of unfinished
+        writes are left out as well.
+        """
+        formats = self.supported_formats if formats is None else formats
+        excluded = {os.path.realpath(p) for p in exclude_paths}
+        stack = [os.fspath(root_dir)]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    subdirs = []
+                    for entry in entries:
+                        try:
+                            # Unfinished output of this or an interrupted run
+                            if _TEMP_MARKER in entry.name:
+                                continue
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name not in exclude_names and os.path.realpath(entry.path) not in excluded:
+                                    subdirs.append(entry.path)
+                            elif os.path.splitext(entry.name)[1].lower() in formats:
+                                yield Path(entry.path)
+                        except OSError:
+                            continue
+            except OSError as e:
+                print(f"Error scanning {directory}: {e}")
+                continue
+            # Reversed so directories are walked in the order scandir listed them
+            stack.extend(reversed(subdirs))
+
     def find_media(self, root_dir: str) -> List[Path]:
         """Find all supported media files in directory and subdirectories."""
-        root_path = Path(root_dir)
-        media_files = []
-        
-        for path in root_path.rglob('*'):
-            if path.suffix.lower() in self.supported_formats:
-                media_files.append(path)
-        
-        return media_files
+        return list(self.iter_media(root_dir))
+
+    @staticmethod
+    def _analyze_jpeg(img, file_size):
+        """Estimate the quality a JPEG was saved with from its headers alone.
+
+        The luminance table is compared against the IJG reference table and
+        the libjpeg quality scaling is inverted. Returns None for non-JPEGs.
+        """
+        tables = getattr(img, 'quantization', None)
+        if img.format != 'JPEG' or not tables:
+            return None
+
+        luminance = tables[min(tables)]
+        scale = sum(luminance) * 100 / sum(_IJG_LUMINANCE_TABLE)
+        estimated = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+        width, height = img.size
+        return {
+            'estimated_quality': max(1, min(100, round(estimated))),
+            'bits_per_pixel': file_size * 8 / (width * height),
+            # 0 is 4:4:4, Pillow saves 4:2:0 which alone shrinks such files
+            'subsampling': JpegImagePlugin.get_sampling(img)
+        }
 
-    def compress_image(self, input_path, output_path=None, quality=85, progress_callback=None):
-        """Compress a single image file."""
+    def _encode_png(self, img, quality, exif_dict, lossy_png=False, name=None, details=None):
+        """Encode img as small a PNG as the time budget allows, returns the BytesIO.
+
+        The image is first reduced losslessly (see _reduce_png), with
+        lossy_png a quantized palette version (see _quantize_png) competes
+        with it. The smallest of those is then encoded with the remaining
+        zlib strategies until _PNG_TIME_BUDGET CPU seconds of this thread
+        are spent. details gets what won under 'png'.
+        """
+        if details is None:
+            details = {}
+        start = time.thread_time()
+        with self._span('png_reduce', file=name):
+            candidates = [_reduce_png(img)]
+            if lossy_png and candidates[0].mode != 'P':
+                quantized = _quantize_png(candidates[0], quality)
+                if quantized is not None:
+                    candidates.append(quantized)
+
+        best = None
+        last_cost = 0.0
+        trials = 0
+        plan = [(candidate, _PNG_STRATEGIES[0]) for candidate in candidates]
+        plan += [(None, strategy) for strategy in _PNG_STRATEGIES[1:]]
+        for candidate, (strategy_name, strategy) in plan:
+            if trials and time.thread_time() - start + last_cost > _PNG_TIME_BUDGET:
+                break
+            # Strategies after the first only retry the smallest candidate
+            candidate = candidate or best[1]
+            trial_start = time.thread_time()
+            buffer = io.BytesIO()
+            with self._span('encode', file=name, format='PNG', mode=candidate.mode, strategy=strategy_name):
+                candidate.save(buffer, format='PNG', compress_level=9, compress_type=strategy, exif=exif_dict)
+            last_cost = time.thread_time() - trial_start
+            trials += 1
+            if best is None or buffer.getbuffer().nbytes < best[0].getbuffer().nbytes:
+                best = (buffer, candidate, strategy_name)
+
+        buffer, candidate, strategy_name = best
+        details['png'] = {
+            'mode': candidate.mode,
+            'lossy': len(candidates) > 1 and candidate is candidates[-1],
+            'strategy': strategy_name,
+            'trials': trials,
+            'cpu_seconds': round(time.thread_time() - start, 3)
+        }
+        return buffer
+
+    def _open_image(self, source, name=None):
+        """Image.open, with errors naming the file rather than the reader it was given"""
+        with self._span('open', file=name):
+            try:
+                return Image.open(source)
+            except UnidentifiedImageError:
+                raise UnidentifiedImageError(f"cannot identify image file {name!r}") from None
+
+    def _read_exif(self, img, name=None):
+        """EXIF of an opened image, empty if it has none or it can't be read"""
+        with self._span('exif', file=name):
+            try:
+                exif_dict = img.getexif()
+                if exif_dict is None:
+                    exif_dict = {}
+            except Exception:
+                exif_dict = {}
+        return exif_dict
+
+    def _apply_orientation(self, img, exif_dict, name=None):
+        """Turn a decoded image upright by its EXIF orientation and mark exif_dict as upright"""
+        orientation = exif_dict.get(274)  # 274 is the orientation tag
+        rotations = {
+            3: Image.Transpose.ROTATE_180,
+            6: Image.Transpose.ROTATE_270,
+            8: Image.Transpose.ROTATE_90
+        }
+        if orientation in rotations:
+            with self._span('orientation', file=name):
+                img = img.transpose(rotations[orientation])
+            exif_dict[274] = 1
+        return img
+
+    def _encode_image(self, source, original_size, quality, output_format=None, heif_fallback=None, name=None,
+                      progress_callback=None, details=None, pre_skip=False, lossy_png=False):
+        """Decode an image and encode it at quality, shared by compress_image and compress_image_bytes.
+
+        source is a path or a file object. output_format defaults to the
+        image's own format, see _REENCODE_FORMATS. With heif_fallback, by
+        default on for JPEG and PNG sources, HEIF is tried as well when the
+        first encode doesn't save 5%. PNGs go through _encode_png, which
+        ignores quality unless lossy_png, and only fall back to HEIF when it
+        is expected to fit in what they left of _PNG_TIME_BUDGET. Returns the
+        BytesIO and format of the encode to keep, or None when the image is skipped as already
+        optimized; details and progress events are filled as in
+        compress_image.
+        """
+        if details is None:
+            details = {}
+        # Open the image and get EXIF
+        img = self._open_image(source, name)
+        with img:
+            exif_dict = self._read_exif(img, name)
+            
+            if heif_fallback is None:
+                heif_fallback = img.format in ('JPEG', 'MPO', 'PNG')
+            
+            # Re-encoding can't plausibly win 5% if the source is well below
+            # the requested quality, dense and has the same chroma subsampling.
+            # The HEIF fallback often still wins, so it is never skipped for.
+            with self._span('analyze', file=name):
+                analysis = self._analyze_jpeg(img, original_size)
+            if analysis:
+                details['analysis'] = analysis
+            if (pre_skip and analysis and not heif_fallback
+                    and analysis['estimated_quality'] <= quality - _JPEG_SKIP_QUALITY_MARGIN
+                    and analysis['bits_per_pixel'] >= _JPEG_SKIP_MIN_BPP
+                    and analysis['subsampling'] != 0):
+                print(f"Skipped {name} (already optimized, estimated quality {analysis['estimated_quality']})")
+                details.update(outcome='skipped', reason='already optimized')
+                if progress_callback:
+                    progress_callback({
+                        'skipped': True,
+                        'current_file': name,
+                        'reason': 'already optimized',
+                        'predicted': True,
+                        **analysis
+                    })
+                return None
+            
+            if output_format is None:
+                if img.format not in _REENCODE_FORMATS:
+                    raise ValueError(f"Unsupported image format: {img.format}")
+                output_format = _REENCODE_FORMATS[img.format]
+            
+            with self._span('decode', file=name):
+                img.load()
+            img = self._apply_orientation(img, exif_dict, name)
+            
+            # Encode every candidate into memory, only the winner is kept
+            if output_format == 'PNG':
+                buffer = self._encode_png(img, quality, exif_dict, lossy_png, name, details)
+                heif_seconds = img.width * img.height * self._heif_seconds_per_pixel
+                if heif_fallback and details['png']['cpu_seconds'] + heif_seconds > _PNG_TIME_BUDGET:
+                    heif_fallback = False
+                    details['png']['heif'] = 'over budget'
+            else:
+                buffer = io.BytesIO()
+                with self._span('encode', file=name, format=output_format):
+                    img.save(buffer, format=output_format, quality=quality, optimize=True, exif=exif_dict)
+            
+            # Check compression ratio
+            compressed_size = buffer.getbuffer().nbytes
+            compression_ratio = compressed_size / original_size
+            
+            # If JPEG compression isn't effective, try HEIC
+            if compression_ratio > 0.95 and heif_fallback:
+                try:
+                    heic_buffer = io.BytesIO()
+                    heif_start = time.perf_counter()
+                    with self._span('encode', file=name, format='HEIF'):
+                        img.save(heic_buffer, format='HEIF', quality=quality)
+                    # x265 encodes on threads of its own, only wall time covers them
+                    self._heif_seconds_per_pixel = (time.perf_counter() - heif_start) / (img.width * img.height)
+                    
+                    if heic_buffer.getbuffer().nbytes < compressed_size:
+                        buffer = heic_buffer
+                        compressed_size = heic_buffer.getbuffer().nbytes
+                        compression_ratio = compressed_size / original_size
+                        output_format = 'HEIF'
+                except Exception as heic_error:
+                    print(f"HEIC conversion failed: {str(heic_error)}")
+            
+            # If compression wasn't effective at all, skip the file
+            if compression_ratio > 0.95:
+                print(f"Skipped {name} (already optimized)")
+                details.update(outcome='skipped', reason='already optimized')
+                if progress_callback:
+                    progress_callback({
+                        'skipped': True,
+                        'current_file': name,
+                        'reason': 'already optimized',
+                        'predicted': False,
+                        **(analysis or {})
+                    })
+                return None
+        return buffer, output_format
+
+    def compress_image_bytes(self, data, quality=85, output_format=None, progress_callback=None, details=None,
+                             pre_skip=False, name='<memory>', lossy_png=False):
+        """Compress an image held in memory, returns a CompressedImage.
+
+        data is bytes, a bytearray, memoryview or other buffer, which is read
+        without copying it, or a binary file object, which is read from its
+        current position. Nothing touches the file system. The image is
+        handled as compress_image handles files: EXIF orientation is applied
+        and already optimized images are skipped. It keeps its format (HEIC
+        becomes JPEG) and JPEGs and PNGs may become HEIF when that is
+        smaller, unless output_format ('JPEG', 'PNG', 'WEBP', 'HEIF') is
+        given. name only appears in messages and events.
+        lossy_png is as for compress_image.
+        """
+        if details is None:
+            details = {}
+        start = time.perf_counter()
+        output = None
+        try:
+            source, original_size = _image_source(data)
+            details['input_bytes'] = original_size
+            encoded = self._encode_image(source, original_size, quality, output_format,
+                                         None if output_format is None else False, name,
+                                         progress_callback, details, pre_skip, lossy_png)
+            if encoded is not None:
+                buffer, output_format = encoded
+                output = buffer.getvalue()
+                details.update(outcome='compressed', output_bytes=len(output), format=output_format)
+        except Exception as e:
+            print(f"Error compressing image {name}: {str(e)}")
+            details.update(outcome='error', reason=str(e))
+        details['seconds'] = time.perf_counter() - start
+        return CompressedImage(
+            outcome=details.get('outcome', 'error'),
+            data=output,
+            format=details.get('format'),
+            input_bytes=details.get('input_bytes'),
+            output_bytes=details.get('output_bytes'),
+            seconds=details['seconds'],
+            reason=details.get('reason')
+        )
+
+    def compress_renditions(self, source, renditions, quality=85, output_path=None, details=None, name=None):
+        """Make several Renditions of one image from a single decode, returns {rendition name: CompressedImage}.
+
+        source is a path, or data as compress_image_bytes takes it. The image
+        is decoded and turned upright once and every rendition is scaled
+        from that copy. JPEGs are decoded at a reduced size (draft mode)
+        when no rendition needs their full resolution. A full size rendition
+        in the image's own format is skipped when it doesn't save 5%, like
+        compress_image does; scaled ones are always kept.
+
+        With output_path the renditions are written next to it as
+        <stem>_<rendition name><suffix>, all of them once every encode has
+        succeeded; details gets their paths under 'outputs'.
+        """
+        if details is None:
+            details = {}
+        renditions = list(renditions)
+        if len({r.name for r in renditions}) != len(renditions):
+            raise ValueError("Rendition names must be unique")
+        for rendition in renditions:
+            if rendition.format is not None and rendition.format not in _FORMAT_SUFFIXES:
+                raise ValueError(f"Unsupported rendition format: {rendition.format}")
+        is_path = isinstance(source, (str, os.PathLike))
+        if name is None:
+            name = Path(source).name if is_path else '<memory>'
+        start = time.perf_counter()
+        encoded = []
+        try:
+            if is_path:
+                original_size = os.stat(source).st_size
+            else:
+                source, original_size = _image_source(source)
+            details['input_bytes'] = original_size
+            img = self._open_image(source, name)
+            with img:
+                exif_dict = self._read_exif(img, name)
+                source_format = _REENCODE_FORMATS.get(img.format)
+                full_size = img.size
+
+                # The JPEG decoder can scale by 1/2, 1/4 or 1/8 for free, as
+                # long as the largest rendition still gets enough pixels
+                sides = [r.max_side for r in renditions]
+                if img.format in ('JPEG', 'MPO') and sides and None not in sides and max(sides) < max(img.size):
+                    factor = max(sides) / max(img.size)
+                    img.draft(img.mode, (math.ceil(img.width * factor), math.ceil(img.height * factor)))
+
+                with self._span('decode', file=name):
+                    img.load()
+                img = self._apply_orientation(img, exif_dict, name)
+
+                for rendition in renditions:
+                    output_format = rendition.format or source_format
+                    if output_format is None:
+                        raise ValueError(f"Unsupported image format: {img.format}")
+                    scaled = img
+                    if rendition.max_side and rendition.max_side < max(img.size):
+                        factor = rendition.max_side / max(img.size)
+                        target = (max(1, round(img.width * factor)), max(1, round(img.height * factor)))
+                        with self._span('resize', file=name, rendition=rendition.name):
+                            scaled = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=_REDUCING_GAP)
+                    if output_format == 'JPEG' and scaled.mode not in ('RGB', 'L', 'CMYK'):
+                        scaled = scaled.convert('RGB')
+
+                    if output_format == 'PNG':
+                        buffer = self._encode_png(scaled, quality, exif_dict, name=name)
+                    else:
+                        buffer = io.BytesIO()
+                        with self._span('encode', file=name, format=output_format, rendition=rendition.name):
+                            scaled.save(buffer, format=output_format, quality=rendition.quality or quality,
+                                        optimize=True, exif=exif_dict)
+                    if (scaled.size in (full_size, full_size[::-1]) and output_format == source_format
+                            and buffer.getbuffer().nbytes / original_size > 0.95):
+                        print(f"Skipped {rendition.name} rendition of {name} (already optimized)")
+                        buffer = None
+                    encoded.append((rendition, output_format, buffer))
+
+            if output_path is not None:
+                output_path = Path(output_path)
+                outputs = {}
+                with self._span('write', file=name):
+                    for rendition, output_format, buffer in encoded:
+                        if buffer is None:
+                            continue
+                        path = output_path.with_name(
+                            f"{output_path.stem}_{rendition.name}{_FORMAT_SUFFIXES[output_format]}"
+                        )
+                        atomic_write(path, buffer.getbuffer())
+                        outputs[rendition.name] = path
+                details['outputs'] = outputs
+        except Exception as e:
+            print(f"Error making renditions of {name}: {str(e)}")
+            details['seconds'] = time.perf_counter() - start
+            return {
+                r.name: CompressedImage('error', None, None, details.get('input_bytes'), None, details['seconds'], str(e))
+                for r in renditions
+            }
+
+        details['seconds'] = time.perf_counter() - start
+        results = {}
+        for rendition, output_format, buffer in encoded:
+            if buffer is None:
+                results[rendition.name] = CompressedImage('skipped', None, output_format, original_size, None,
+                                                          details['seconds'], 'already optimized')
+            else:
+                data = buffer.getvalue()
+                results[rendition.name] = CompressedImage('compressed', data, output_format, original_size,
+                                                          len(data), details['seconds'], None)
+        return results
+
+    def compress_image(self, input_path, output_path=None, quality=85, progress_callback=None, details=None, pre_skip=False,
+                       data=None, defer_write=False, lossy_png=False):
+        """Compress a single image file.
+
+        details, if given, gets the outcome, output path and skip reason.
+        data is input_path's content if it was already read; with
+        defer_write the encode is left in details['output_data'] for the
+        caller to write. output_path == input_path compresses in place.
+        """
+        if details is None:
+            details = {}
         try:
             input_path = Path(input_path)
             
@@ -80,148 +2121,371 @@ class MediaCompressor:
                 output_path = output_dir / input_path.name
             else:
                 output_path = Path(output_path)
+            # Replacing the source itself, see compress_directory's replace_files
+            in_place = os.path.abspath(output_path) == os.path.abspath(input_path)
 
-            # Open the image and get EXIF
-            with Image.open(input_path) as img:
-                # Get original EXIF data
-                try:
-                    exif_dict = img.getexif()
-                    if exif_dict is None:
-                        exif_dict = {}
-                except Exception:
-                    exif_dict = {}
-                
-                # Preserve orientation
-                orientation = exif_dict.get(274)  # 274 is the orientation tag
-                if orientation:
-                    rotations = {
-                        3: Image.Transpose.ROTATE_180,
-                        6: Image.Transpose.ROTATE_270,
-                        8: Image.Transpose.ROTATE_90
-                    }
-                    if orientation in rotations:
-                        img = img.transpose(rotations[orientation])
-                        exif_dict[274] = 1
-                
-                # Get original file size
-                original_size = input_path.stat().st_size
-                self.compression_stats['original_size'] += original_size
-                
-                # Save with EXIF data
-                if input_path.suffix.lower() == '.heic':
-                    output_path = output_path.with_suffix('.jpg')
-                
-                img.save(output_path, quality=quality, optimize=True, exif=exif_dict)
-                
-                # Check compression ratio
-                compressed_size = output_path.stat().st_size
-                compression_ratio = compressed_size / original_size
-                
-                # If JPEG compression isn't effective, try HEIC
-                if compression_ratio > 0.95 and input_path.suffix.lower() in {'.jpg', '.jpeg', '.png'}:
-                    heic_path = output_path.with_suffix('.heic')
-                    try:
-                        img.save(heic_path, format='HEIF', quality=quality)
-                        
-                        if heic_path.stat().st_size < compressed_size:
-                            compressed_size = heic_path.stat().st_size
-                            output_path.unlink()
-                            output_path = heic_path
-                        else:
-                            heic_path.unlink()
-                    except Exception as heic_error:
-                        print(f"HEIC conversion failed: {str(heic_error)}")
-                        if heic_path.exists():
-                            heic_path.unlink()
-                
-                # If compression wasn't effective at all, skip the file
-                if compression_ratio > 0.95:
-                    output_path.unlink()
-                    print(f"Skipped {input_path.name} (already optimized)")
-                    self.compression_stats['files_skipped'] += 1
-                    if progress_callback:
-                        progress_callback({
-                            'skipped': True,
-                            'current_file': input_path.name,
-                            'reason': 'already optimized'
-                        })
-                    return False
-                    
-                print(f"Compressed image: {input_path.name} (ratio: {compression_ratio:.2f})")
-                self.compression_stats['compressed_size'] += compressed_size
-                self.compression_stats['files_processed'] += 1
-                return True
+            name = input_path.name
+            # Get original file size
+            with self._span('stat', file=name):
+                original_size = len(data) if data is not None else input_path.stat().st_size
+            details['input_bytes'] = original_size
+
+            # In place the file keeps its name and so its format
+            if input_path.suffix.lower() == '.heic' and not in_place:
+                output_path = output_path.with_suffix('.jpg')
+            output_format = Image.registered_extensions()[output_path.suffix.lower()]
+            heif_fallback = input_path.suffix.lower() in {'.jpg', '.jpeg', '.png'} and not in_place
+
+            source = _image_source(data)[0] if data is not None else input_path
+            encoded = self._encode_image(source, original_size, quality, output_format, heif_fallback, name,
+                                         progress_callback, details, pre_skip, lossy_png)
+            if encoded is None:
+                return False
+            buffer, output_format = encoded
+            if output_format == 'HEIF':
+                output_path = output_path.with_suffix('.heic')
+            compressed_size = buffer.getbuffer().nbytes
+            compression_ratio = compressed_size / original_size
+            
+            # Written once the source is closed, Windows can't replace open files
+            if defer_write:
+                details['output_data'] = buffer
+            else:
+                with self._span('write', file=name):
+                    atomic_write(output_path, buffer.getbuffer(), like=input_path if in_place else None)
+            
+            print(f"Compressed image: {input_path.name} (ratio: {compression_ratio:.2f})")
+            details.update(outcome='compressed', output_path=output_path,
+                           output_bytes=compressed_size, format=output_format)
+            return True
                 
         except Exception as e:
             print(f"Error compressing image {input_path.name}: {str(e)}")
-            self.compression_stats['files_skipped'] += 1
+            details.update(outcome='error', reason=str(e))
             if progress_callback:
                 progress_callback('skipped')
             return False
 
-    def compress_video(self, input_path, output_path, quality=23, use_hardware=True, codec='h264', progress_callback=None):
+    def probe_video(self, input_path):
+        """Read codec, resolution, frame rate, duration and bitrates with ffprobe
+
+        Returns None if the file has no video stream or can't be probed.
+        """
+        try:
+            info = ffmpeg.probe(str(input_path), cmd=self.ffprobe_path)
+        except (ffmpeg.Error, OSError) as e:
+            message = e.stderr.decode(errors='replace').strip() if getattr(e, 'stderr', None) else str(e)
+            print(f"Could not probe {Path(input_path).name}: {message}")
+            return None
+
+        streams = info.get('streams', [])
+        video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+        audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+        if video is None:
+            return None
+
+        container = info.get('format', {})
+        num, _, den = (video.get('avg_frame_rate') or '0/1').partition('/')
+        fps = float(num) / float(den or 1) if float(den or 1) else 0.0
+        duration = float(video.get('duration') or container.get('duration') or 0)
+        total_bitrate = int(container.get('bit_rate') or 0)
+        audio_bitrate = int(audio.get('bit_rate') or 0) if audio else 0
+        # Containers like mkv only know the overall bitrate
+        bitrate = int(video.get('bit_rate') or 0) or max(total_bitrate - audio_bitrate, 0)
+
+        return {
+            'codec': video.get('codec_name'),
+            'width': int(video.get('width') or 0),
+            'height': int(video.get('height') or 0),
+            'fps': fps,
+            'duration': duration,
+            'bitrate': bitrate,
+            'total_bitrate': total_bitrate,
+            'audio_codec': audio.get('codec_name') if audio else None,
+            'audio_bitrate': audio_bitrate
+        }
+
+    @staticmethod
+    def _predict_video_bitrate(probe, quality, codec):
+        """Estimate the video bitrate an encode at quality would end up with"""
+        if not (probe['width'] and probe['height'] and probe['fps']):
+            return None
+        crf = (100 - quality) * 51 / 100
+        bpp = _VIDEO_BPP_AT_CRF23.get(codec, _VIDEO_BPP_AT_CRF23['h264']) * 2 ** ((23 - crf) / 6)
+        return int(bpp * probe['width'] * probe['height'] * probe['fps'])
+
+    @staticmethod
+    def _parse_progress_value(value, cast=float):
+        try:
+            return cast(value.rstrip('x'))
+        except (ValueError, AttributeError):
+            return None
+
+    def _ffmpeg_args(self, stream):
+        """Command line for an ffmpeg-python stream, with progress written to stdout"""
+        # Outputs are our own temp files, which already exist
+        return ffmpeg.compile(stream.global_args('-y', '-nostdin', '-nostats', '-progress', 'pipe:1'), cmd=self.ffmpeg_path)
+
+    @classmethod
+    def _progress_event(cls, block, value, duration=None, current_file=None):
+        """Turn one -progress block of key=value pairs into a 'video_progress' event"""
+        # out_time_ms is in microseconds as well, despite its name
+        out_time_us = cls._parse_progress_value(block.get('out_time_us'), int)
+        out_time = out_time_us / 1_000_000 if out_time_us is not None else None
+        speed = cls._parse_progress_value(block.get('speed'))
+        event = {
+            'video_progress': True,
+            'current_file': current_file,
+            'frame': cls._parse_progress_value(block.get('frame'), int),
+            'fps': cls._parse_progress_value(block.get('fps')),
+            'speed': speed,
+            'out_time': out_time,
+            'done': value == 'end'
+        }
+        if duration and out_time is not None:
+            event['percent'] = min(out_time / duration * 100, 100)
+            if speed:
+                event['eta'] = max(duration - out_time, 0) / speed
+        return event
+
+    def _run_ffmpeg(self, stream, duration=None, progress_callback=None, current_file=None):
+        """Run an ffmpeg-python stream and report progress while it encodes.
+
+        ffmpeg writes key=value blocks to stdout (-progress pipe:1) which are
+        parsed as they arrive and passed on as 'video_progress' events with
+        frame, fps, speed, encoded time and, when duration is known, percent
+        and ETA. Only the last lines of stderr are kept for error reporting.
+        Raises ffmpeg.Error like ffmpeg.run does.
+        """
+        process = subprocess.Popen(self._ffmpeg_args(stream), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        stderr_tail = deque(maxlen=_FFMPEG_STDERR_LINES)
+        def read_stderr():
+            for line in process.stderr:
+                stderr_tail.append(line)
+        stderr_reader = threading.Thread(target=read_stderr, daemon=True)
+        stderr_reader.start()
+
+        progress = _FfmpegProgress(duration, current_file)
+        for raw_line in process.stdout:
+            event = progress.feed(raw_line)
+            if event is not None and progress_callback:
+                progress_callback(event)
+
+        process.wait()
+        stderr_reader.join()
+        if process.returncode != 0:
+            raise ffmpeg.Error('ffmpeg', b'', b''.join(stderr_tail))
+
+    def _encode_segmented(self, input_path, output_path, crf, probe, workers, progress_callback=None, current_file=None):
+        """Encode a long video with libx264 as keyframe-aligned segments in parallel.
+
+        The video stream is cut with the segment muxer without re-encoding, so
+        every segment starts at a keyframe of the source. Up to workers
+        segments are encoded at a time while the audio is encoded once next to
+        them, then the pieces are joined with the concat demuxer, again
+        without re-encoding. The result must match the source's duration and
+        stream count, otherwise ValueError is raised. Failing ffmpeg steps
+        raise ffmpeg.Error. Temporary files are always removed.
+        """
+        current_file = current_file or Path(input_path).name
+        has_audio = probe.get('audio_codec') is not None
+        work_dir = Path(tempfile.mkdtemp(prefix=f'{_TEMP_MARKER}-segments-', dir=Path(output_path).parent))
+
+        def run(stage, job, **args):
+            with self._span(stage, file=current_file, **args):
+                self._run_ffmpeg(job)
+
+        try:
+            run('split', ffmpeg.input(input_path).output(
+                str(work_dir / 'source_%05d.mkv'), map='0:v:0', c='copy', f='segment',
+                segment_time=_SEGMENT_SECONDS, reset_timestamps=1
+            ))
+            sources = sorted(work_dir.glob('source_*.mkv'))
+            if not sources:
+                raise ValueError("splitting produced no segments")
+
+            # Share the cores between the segments that encode at the same time
+            threads = max(1, (os.cpu_count() or 1) // workers)
+            jobs = []
+            for index, source in enumerate(sources):
+                encoded = work_dir / source.name.replace('source_', 'encoded_')
+                jobs.append(('encode_segment', ffmpeg.input(str(source)).output(
+                    str(encoded), vcodec='libx264', preset='medium', crf=str(crf), an=None, threads=threads
+                ), {'segment': index}))
+            audio_path = work_dir / 'audio.m4a'
+            if has_audio:
+                jobs.append(('encode_audio', ffmpeg.input(input_path).output(
+                    str(audio_path), map='0:a:0', vn=None, acodec='aac', audio_bitrate='128k'
+                ), {}))
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Each job runs in a copy of our context, so a caller's context
+                # variables (see media_compressor_async) reach the segment encodes
+                futures = [pool.submit(contextvars.copy_context().run, run, stage, job, **args)
+                           for stage, job, args in jobs]
+                try:
+                    for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                        future.result()
+                        if progress_callback:
+                            progress_callback({
+                                'video_progress': True,
+                                'current_file': current_file,
+                                'percent': done / len(futures) * 100,
+                                'segments': len(sources),
+                                'jobs_done': done,
+                                'done': done == len(futures)
+                            })
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+            listing = work_dir / 'segments.txt'
+            listing.write_text(''.join(f"file '{source.name.replace('source_', 'encoded_')}'\n" for source in sources))
+            streams = [ffmpeg.input(str(listing), f='concat', safe=0)['v']]
+            if has_audio:
+                streams.append(ffmpeg.input(str(audio_path))['a'])
+            run('concat', ffmpeg.output(*streams, output_path, c='copy'))
+
+            # Every segment boundary may shift the end by up to a frame
+            with self._span('verify', file=current_file):
+                info = ffmpeg.probe(output_path, cmd=self.ffprobe_path)
+            output_streams = info.get('streams', [])
+            video = next((s for s in output_streams if s.get('codec_type') == 'video'), {})
+            duration = float(video.get('duration') or info.get('format', {}).get('duration') or 0)
+            tolerance = max(0.5, len(sources) / probe['fps']) if probe['fps'] else 1.0
+            expected_streams = 2 if has_audio else 1
+            if len(output_streams) != expected_streams or abs(duration - probe['duration']) > tolerance:
+                raise ValueError(f"output has {len(output_streams)} streams and {duration:.2f}s, "
+                                 f"expected {expected_streams} and {probe['duration']:.2f}s")
+            print(f"Encoded {current_file} as {len(sources)} segments with {workers} workers")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def compress_video(self, input_path, output_path, quality=23, use_hardware=True, codec='h264', progress_callback=None, details=None, pre_skip=True, segment_workers=None):
+        """Compress a single video file with ffmpeg.
+
+        details is filled as in compress_image, plus the source's ffprobe
+        metadata under 'probe'. pre_skip skips sources whose bitrate the
+        encode wouldn't lower; long software encodes are split between
+        segment_workers ffmpeg processes, see _encode_segmented.
+        """
+        if details is None:
+            details = {}
         try:
             input_path = str(input_path)
             output_path = str(output_path)
-            if not output_path.lower().endswith(('.mp4', '.mkv')):
-                output_path += '.mp4'
+            in_place = os.path.abspath(output_path) == os.path.abspath(input_path)
+            if in_place:
+                if Path(input_path).suffix.lower() not in _IN_PLACE_VIDEO_FORMATS:
+                    print(f"Skipped {Path(input_path).name} (can't be replaced in place)")
+                    details.update(outcome='skipped', reason="container can't be replaced in place")
+                    if progress_callback:
+                        progress_callback({
+                            'skipped': True,
+                            'current_file': Path(input_path).name,
+                            'reason': "container can't be replaced in place"
+                        })
+                    return False
+            else:
+                output_path = _video_output_path(input_path, output_path)
 
+            name = Path(input_path).name
             # Get original file size
-            original_size = os.path.getsize(input_path)
+            with self._span('stat', file=name):
+                original_size = os.path.getsize(input_path)
+            details['input_bytes'] = original_size
+            
+            # Look at the source first, encodes that can't shrink it are skipped
+            if pre_skip:
+                with self._span('probe', file=name):
+                    probe = self.probe_video(input_path)
+                if probe:
+                    details['probe'] = probe
+                    # Software encoding always uses libx264
+                    target = codec if use_hardware and self.hw_encoders.get(codec) else 'h264'
+                    predicted = self._predict_video_bitrate(probe, quality, target)
+                    details['predicted_bitrate'] = predicted
+                    if predicted and probe['bitrate'] and predicted >= probe['bitrate'] * _VIDEO_SKIP_MARGIN:
+                        print(f"Skipped {Path(input_path).name} (already optimized, "
+                              f"{probe['codec']} at {probe['bitrate'] // 1000} kb/s, "
+                              f"encode predicted at {predicted // 1000} kb/s)")
+                        details.update(outcome='skipped', reason='already optimized')
+                        if progress_callback:
+                            progress_callback({
+                                'skipped': True,
+                                'current_file': Path(input_path).name,
+                                'reason': 'already optimized',
+                                'predicted': True,
+                                'probe': probe,
+                                'predicted_bitrate': predicted
+                            })
+                        return False
             
             # Convert quality value (0-100) to appropriate range for each encoder
-            nvenc_quality = int((100 - quality) * 51 / 100)
+            hw_quality = int((100 - quality) * 51 / 100)
             crf_quality = int((100 - quality) * 51 / 100)
 
-            stream = ffmpeg.input(input_path)
+            encoder = self.hw_encoders.get(codec) if use_hardware else None
+            input_options = {'vaapi_device': _VAAPI_DEVICE} if encoder and encoder.endswith('_vaapi') else {}
+            source = ffmpeg.input(input_path, **input_options)
             output_options = {
                 'acodec': 'aac',
                 'audio_bitrate': '128k'
             }
 
-            if use_hardware:
-                try:
-                    if codec == 'h265':
-                        output_options.update({
-                            'vcodec': 'hevc_nvenc',
-                            'preset': 'p4',
-                            'rc': 'vbr',
-                            'cq': nvenc_quality,
-                            'gpu': '0'
-                        })
-                    else:
-                        output_options.update({
-                            'vcodec': 'h264_nvenc',
-                            'preset': 'p4',
-                            'rc': 'vbr',
-                            'cq': nvenc_quality,
-                            'gpu': '0'
-                        })
-                except ffmpeg.Error:
-                    use_hardware = False
-
-            if not use_hardware:
+            if encoder:
+                output_options.update(self._hw_encoder_options(encoder, hw_quality))
+            else:
+                use_hardware = False
                 output_options.update({
                     'vcodec': 'libx264',
                     'preset': 'medium',
                     'crf': str(crf_quality)
                 })
+            details['encoder'] = output_options['vcodec']
 
-            stream = ffmpeg.output(stream, output_path, **output_options)
+            if segment_workers is None:
+                segment_workers = max(1, min(4, (os.cpu_count() or 1) // 2))
+            probe = details.get('probe')
+            if not use_hardware and segment_workers > 1 and probe is None:
+                with self._span('probe', file=name):
+                    probe = self.probe_video(input_path)
+                if probe:
+                    details['probe'] = probe
 
             try:
-                ffmpeg.run(stream, capture_stdout=True, capture_stderr=True)
-                
-                # Check if compressed file is larger
-                if os.path.getsize(output_path) >= os.path.getsize(input_path):
-                    os.remove(output_path)
-                    if progress_callback:
-                        progress_callback('larger')
-                    return False
-                    
-                # Update compression stats
-                self.compression_stats['original_size'] += original_size
-                self.compression_stats['compressed_size'] += os.path.getsize(output_path)
+                with _AtomicOutput(output_path, like=input_path if in_place else None) as out:
+                    segmented = False
+                    if not use_hardware and segment_workers > 1 and probe and probe['duration'] >= _SEGMENT_MIN_DURATION:
+                        try:
+                            self._encode_segmented(input_path, str(out.tmp), crf_quality, probe, segment_workers,
+                                                   progress_callback, Path(input_path).name)
+                            segmented = True
+                        except (ffmpeg.Error, ValueError, OSError) as e:
+                            message = e.stderr.decode(errors='replace').strip() if getattr(e, 'stderr', None) else str(e)
+                            print(f"Segmented encoding failed, encoding {Path(input_path).name} in one piece: {message}")
+                    details['segmented'] = segmented
+
+                    if not segmented:
+                        stream = ffmpeg.output(source, str(out.tmp), **output_options)
+                        with self._span('encode', file=name, encoder=details['encoder']):
+                            self._run_ffmpeg(stream, probe['duration'] if probe else None, progress_callback, name)
+
+                    # Check if compressed file is larger
+                    with self._span('stat', file=name):
+                        output_bytes = os.path.getsize(out.tmp)
+                    if output_bytes >= original_size:
+                        details.update(outcome='skipped', reason='output larger than input')
+                        if progress_callback:
+                            progress_callback('larger')
+                        return False
+                    with self._span('replace', file=name):
+                        out.commit()
+
+                details.update(outcome='compressed', output_path=Path(output_path),
+                               output_bytes=output_bytes, format=Path(output_path).suffix[1:])
                 return True
                 
             except ffmpeg.Error as e:
@@ -230,11 +2494,13 @@ class MediaCompressor:
                 
                 if use_hardware:
                     print("Hardware encoding failed, falling back to software encoding...")
-                    return self.compress_video(input_path, output_path, quality, False, 'h264', progress_callback)
+                    return self.compress_video(input_path, output_path, quality, False, 'h264', progress_callback, details,
+                                               pre_skip=False, segment_workers=segment_workers)
+                details.update(outcome='error', reason=error_message.strip().splitlines()[-1] if error_message.strip() else 'ffmpeg failed')
                 return False
-
         except Exception as e:
             print(f"Error compressing video: {str(e)}")
+            details.update(outcome='error', reason=str(e))
             if progress_callback:
                 progress_callback('skipped')
             return False
@@ -263,88 +2529,51 @@ class MediaCompressor:
             print(f"Unsupported format: {suffix}")
             return False
 
-    def compress_directory(self, media_files, output_dir, quality, thread_count, progress_callback=None, cancel_check=None, use_hardware=True, codec='h265', replace_files=False):
-        """Compress multiple files with progress tracking and cancellation support"""
-        total_files = len(media_files)
-        successful = 0
-        self.compression_stats = {
-            'original_size': 0,
-            'compressed_size': 0,
-            'files_processed': 0,
-            'files_skipped': 0
-        }
+    def compress_directory(self, media_files, output_dir, quality, thread_count, progress_callback=None,
+                           cancel_check=None, use_hardware=True, codec='h265', replace_files=False, engine='thread',
+                           video_workers=1, cache=None, scan_queue_size=1000, layout='flat', source_root=None,
+                           segment_workers=None, tracer=None, read_ahead=None, read_ahead_bytes=256 * 1024 * 1024,
+                           write_behind=None, write_behind_bytes=256 * 1024 * 1024, io_threads=4, journal=None,
+                           inputs=None, memory_budget=None, autotune=False, lossy_png=False, pre_skip_images=False):
+        """Compress multiple files with progress tracking and cancellation support
 
-        def update_progress():
-            if progress_callback:
-                progress_callback({
-                    'progress': (successful / total_files * 100) if total_files > 0 else 0,
-                    'files_processed': successful,
-                    'total_files': total_files
-                })
-
-        def process_single_file(file_path):
-            nonlocal successful
-            
-            # Check for cancellation
-            if cancel_check and cancel_check():
-                return
-            
-            try:
-                output_path = output_dir / file_path.name
-                if file_path.suffix.lower() in self.supported_image_formats:
-                    result = self.compress_image(file_path, output_path, quality, progress_callback)
-                else:
-                    result = self.compress_video(file_path, output_path, quality, use_hardware, codec, progress_callback)
-                
-                if result:
-                    successful += 1
-                    
-                if progress_callback:
-                    progress_callback({
-                        'progress': (successful / total_files * 100) if total_files > 0 else 0,
-                        'files_processed': successful,
-                        'total_files': total_files,
-                        'current_file': file_path.name
-                    })
-                    
-            except Exception as e:
-                print(f"Error processing {file_path}: {e}")
-                if progress_callback:
-                    progress_callback('error')
-
-        # Process files with thread pool
-        with ThreadPoolExecutor(max_workers=thread_count) as executor:
-            futures = []
-            for f in media_files:
-                if cancel_check and cancel_check():
-                    executor.shutdown(wait=False)
-                    return self._get_stats(total_files, successful)
-                futures.append(executor.submit(process_single_file, f))
-            
-            # Wait for completion and handle errors
-            for future in concurrent.futures.as_completed(futures):
-                if cancel_check and cancel_check():
-                    executor.shutdown(wait=False)
-                    break
-                try:
-                    future.result()
-                except Exception as e:
-                    print(f"Thread error: {str(e)}")
-        
-        return self._get_stats(total_files, successful)
+        media_files may be any iterable, files are compressed as they are
+        found. inputs, such as the roots and formats media_files came from,
+        lets a resumed journal skip walking them again. Every file's
+        FileResult is kept in results, the returned stats add lane, stage
+        and memory figures. See _DirectoryRun.
+        """
+        if engine not in ('thread', 'process'):
+            raise ValueError(f"Unknown engine: {engine}")
+        if layout not in ('flat', 'mirror'):
+            raise ValueError(f"Unknown layout: {layout}")
+        if layout == 'mirror' and source_root is None:
+            raise ValueError("The mirror layout needs a source_root")
+        return _DirectoryRun(
+            self, media_files, output_dir, quality=quality, thread_count=thread_count,
+            progress_callback=progress_callback, cancel_check=cancel_check, use_hardware=use_hardware, codec=codec,
+            replace_files=replace_files, engine=engine, video_workers=video_workers, cache=cache,
+            scan_queue_size=scan_queue_size, layout=layout, source_root=source_root, segment_workers=segment_workers,
+            tracer=tracer, read_ahead=read_ahead, read_ahead_bytes=read_ahead_bytes, write_behind=write_behind,
+            write_behind_bytes=write_behind_bytes, io_threads=io_threads, journal=journal, inputs=inputs,
+            memory_budget=memory_budget, autotune=autotune, lossy_png=lossy_png, pre_skip_images=pre_skip_images
+        ).run()
     
-    def _get_stats(self, total, successful):
-        space_saved = self.compression_stats['original_size'] - self.compression_stats['compressed_size']
-        ratio = (self.compression_stats['compressed_size'] / self.compression_stats['original_size'] * 100) if self.compression_stats['original_size'] > 0 else 100
+    def _get_stats(self, total):
+        stats = self.compression_stats
+        space_saved = stats['original_size'] - stats['compressed_size']
+        ratio = (stats['compressed_size'] / stats['original_size'] * 100) if stats['original_size'] > 0 else 100
         
         return {
             'total_files': total,
-            'successful': successful,
+            'successful': stats['files_processed'],
             'space_saved': space_saved,
             'ratio': ratio,
-            'skipped': self.compression_stats['files_skipped'],
-            'original_size': self.compression_stats['original_size'],
-            'compressed_size': self.compression_stats['compressed_size']
+            'skipped': stats['files_skipped'],
+            'cached': stats['files_cached'],
+            'errors': stats['files_failed'],
+            'original_size': stats['original_size'],
+            'compressed_size': stats['compressed_size']
         }
 
     def compress_media(self, quality):
@@ -363,6 +2592,10 @@ class MediaCompressor:
 
     def start_compression(self):
         """Start the compression process"""
+        # GUI only, Tk is imported on first use so headless imports don't need it
+        import multiprocessing
+        import tkinter.messagebox as messagebox
+
         if not hasattr(self, 'directory'):
             messagebox.showerror("Error", "Please select a directory first")
             return
@@ -423,6 +2656,9 @@ class MediaCompressor:
 
     def save_settings(self):
         """Save current settings with error handling and validation"""
+        import multiprocessing
+        import tkinter.messagebox as messagebox
+
         try:
             settings = {
                 'quality': int(self.quality_var.get()),
@@ -454,6 +2690,9 @@ class MediaCompressor:
 
     def create_summary_ui(self, main_frame):
         """Create an enhanced summary UI with charts and detailed statistics"""
+        import tkinter as tk
+        import tkinter.ttk as ttk
+
         # Title with better styling
         title_frame = ttk.Frame(main_frame)
         title_frame.pack(fill=tk.X, pady=(0, 20))
@@ -495,6 +2734,8 @@ class MediaCompressor:
 
     def add_features(self):
         """Add additional features to enhance user experience"""
+        from tkinterdnd2 import DND_FILES
+
         # Add drag and drop support
         self.root.drop_target_register(DND_FILES)
         self.root.dnd_bind('<<Drop>>', self.handle_drop)
@@ -0,0 +1,280 @@
+"""asyncio front end of compressit.py for async services
+
+AsyncMediaCompressor does the same work as MediaCompressor without blocking
+the event loop: images are compressed on a thread pool, ffmpeg runs as
+asyncio subprocesses, and images and videos each have their own concurrency
+limit. compress_many yields one FileResult per input in the order they
+finish. Cancelling the task that awaits a file kills its ffmpeg process and
+removes its temp files before the cancellation is passed on.
+
+Example:
+    async with AsyncMediaCompressor(image_workers=8, video_workers=2) as compressor:
+        async for result in compressor.compress_many(paths, output_dir, quality=80):
+            print(result.path, result.outcome)
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import ffmpeg
+
+from media_compressor import FileResult, MediaCompressor, _FFMPEG_STDERR_LINES, _FfmpegProgress
+
+
+class _Job:
+    """Cancellation state of one file, shared with the thread compressing it"""
+    def __init__(self, loop):
+        self.loop = loop
+        self.cancelled = False
+        self.ffmpeg = set()
+        self.lock = threading.Lock()
+
+# The _Job of the file the current thread is compressing
+_current_job = contextvars.ContextVar('compressit_job', default=None)
+
+
+async def _run_ffmpeg(args, duration=None, progress_callback=None, current_file=None):
+    """Run ffmpeg as an asyncio subprocess, it is killed if the task is cancelled.
+
+    Reports progress and raises ffmpeg.Error like MediaCompressor._run_ffmpeg.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+
+    stderr_tail = deque(maxlen=_FFMPEG_STDERR_LINES)
+    async def read_stderr():
+        async for line in process.stderr:
+            stderr_tail.append(line)
+    stderr_reader = asyncio.ensure_future(read_stderr())
+
+    try:
+        progress = _FfmpegProgress(duration, current_file)
+        async for raw_line in process.stdout:
+            event = progress.feed(raw_line)
+            if event is not None and progress_callback:
+                progress_callback(event)
+        await process.wait()
+        await stderr_reader
+    except asyncio.CancelledError:
+        stderr_reader.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        raise ffmpeg.Error('ffmpeg', b'', b''.join(stderr_tail))
+
+
+class _AsyncioCompressor(MediaCompressor):
+    """MediaCompressor that hands its ffmpeg runs to the event loop of the current _Job"""
+    def _run_ffmpeg(self, stream, duration=None, progress_callback=None, current_file=None):
+        job = _current_job.get()
+        if job is None:
+            return super()._run_ffmpeg(stream, duration, progress_callback, current_file)
+        with job.lock:
+            # Also stops the software retry after a cancelled hardware encode
+            if job.cancelled:
+                raise ffmpeg.Error('ffmpeg', b'', b'cancelled')
+            future = asyncio.run_coroutine_threadsafe(
+                _run_ffmpeg(self._ffmpeg_args(stream), duration, progress_callback, current_file), job.loop
+            )
+            job.ffmpeg.add(future)
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise ffmpeg.Error('ffmpeg', b'', b'cancelled')
+        finally:
+            with job.lock:
+                job.ffmpeg.discard(future)
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
+
+
+class AsyncMediaCompressor:
+    """Compress images and videos from asyncio code.
+
+    At most image_workers images and video_workers videos are compressed at
+    a time. segment_workers is passed on to compress_video. Other keyword
+    arguments go to MediaCompressor. progress_callback receives the same
+    events as with MediaCompressor, always called on the event loop.
+    """
+    def __init__(self, image_workers=None, video_workers=1, segment_workers=None, **compressor_options):
+        self.compressor = _AsyncioCompressor(**compressor_options)
+        self.image_workers = image_workers or os.cpu_count() or 1
+        self.video_workers = video_workers
+        self.segment_workers = segment_workers
+        # Runs the image encodes and the threads driving the ffmpeg runs
+        self._executor = ThreadPoolExecutor(max_workers=self.image_workers + self.video_workers,
+                                            thread_name_prefix='compressit-async')
+        # Created on first use, inside the running loop
+        self._limits = None
+
+    def kind_of(self, path):
+        """'image', 'video' or None for files that aren't supported"""
+        suffix = Path(path).suffix.lower()
+        if suffix in self.compressor.supported_image_formats:
+            return 'image'
+        if suffix in self.compressor.supported_video_formats:
+            return 'video'
+        return None
+
+    def _limit(self, kind):
+        if self._limits is None:
+            self._limits = {
+                'image': asyncio.Semaphore(self.image_workers),
+                'video': asyncio.Semaphore(self.video_workers)
+            }
+        return self._limits[kind]
+
+    async def _run(self, job, call):
+        """Run call on the executor as job, on cancel stop its ffmpeg runs and wait for it to clean up"""
+        context = contextvars.copy_context()
+        context.run(_current_job.set, job)
+        future = job.loop.run_in_executor(self._executor, context.run, call)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            with job.lock:
+                job.cancelled = True
+                for running in job.ffmpeg:
+                    running.cancel()
+            # Threads can't be interrupted, an image encode runs to its end
+            await asyncio.wait([future])
+            raise
+
+    async def compress(self, input_path, output_path, quality=80, codec='h265', use_hardware=True,
+                       progress_callback=None):
+        """Compress one file to output_path and return its FileResult
+
+        Raises ValueError for unsupported files.
+        """
+        input_path = Path(input_path)
+        kind = self.kind_of(input_path)
+        if kind is None:
+            raise ValueError(f"Unsupported format: {input_path.suffix}")
+        loop = asyncio.get_running_loop()
+        if progress_callback:
+            progress_callback = functools.partial(loop.call_soon_threadsafe, progress_callback)
+
+        details = {}
+        async with self._limit(kind):
+            start = time.perf_counter()
+            if kind == 'image':
+                call = functools.partial(self.compressor.compress_image, input_path, output_path, quality,
+                                         progress_callback, details)
+            else:
+                call = functools.partial(self.compressor.compress_video, input_path, output_path, quality,
+                                         use_hardware, codec, progress_callback, details,
+                                         segment_workers=self.segment_workers)
+            await self._run(_Job(loop), call)
+            details['seconds'] = time.perf_counter() - start
+        return FileResult.from_details(input_path, kind, details)
+
+    async def compress_image_bytes(self, data, quality=80, output_format=None, progress_callback=None, name='<memory>'):
+        """Compress an image held in memory, returns a CompressedImage
+
+        See MediaCompressor.compress_image_bytes, data isn't copied and
+        nothing is written to disk.
+        """
+        loop = asyncio.get_running_loop()
+        if progress_callback:
+            progress_callback = functools.partial(loop.call_soon_threadsafe, progress_callback)
+        async with self._limit('image'):
+            call = functools.partial(self.compressor.compress_image_bytes, data, quality, output_format,
+                                     progress_callback, name=name)
+            return await self._run(_Job(loop), call)
+
+    async def compress_renditions(self, source, renditions, quality=80, output_path=None, name=None):
+        """Make several Renditions of one image from a single decode, returns {rendition name: CompressedImage}
+
+        See MediaCompressor.compress_renditions.
+        """
+        loop = asyncio.get_running_loop()
+        async with self._limit('image'):
+            call = functools.partial(self.compressor.compress_renditions, source, renditions, quality,
+                                     output_path, name=name)
+            return await self._run(_Job(loop), call)
+
+    async def compress_many(self, inputs, output_dir, quality=80, codec='h265', use_hardware=True,
+                            progress_callback=None):
+        """Compress every input into output_dir, yielding FileResults as files finish
+
+        inputs is an iterable or an async iterable of paths. It is consumed
+        as room frees up, at most twice the combined worker count of files
+        are waiting or running. Unsupported files are skipped. output_dir is
+        created if needed; an input named like an earlier one, extension aside, gets
+        an error result instead of overwriting that one's output. Closing the
+        iterator or cancelling the task iterating it cancels the files still
+        running.
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        # Output claim (see MediaCompressor._output_claim) -> the input writing it
+        output_owners = {}
+        source = inputs.__aiter__() if hasattr(inputs, '__aiter__') else _aiter(inputs)
+        room = 2 * (self.image_workers + self.video_workers)
+        running = {}
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(running) < room:
+                    try:
+                        path = Path(await source.__anext__())
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    kind = self.kind_of(path)
+                    if kind is None:
+                        print(f"Skipping unsupported file {path}")
+                        continue
+                    output_path = output_dir / path.name
+                    owner = output_owners.setdefault(self.compressor._output_claim(path, output_path), path)
+                    if owner != path:
+                        print(f"Skipped {path} (same output name as {owner})")
+                        yield FileResult.from_details(path, kind, {
+                            'outcome': 'error',
+                            'reason': f"same output name as {owner}"
+                        })
+                        continue
+                    task = asyncio.ensure_future(self.compress(path, output_path, quality, codec,
+                                                               use_hardware, progress_callback))
+                    running[task] = path
+                if not running:
+                    return
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    path = running.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        print(f"Error processing {path}: {e}")
+                        result = FileResult.from_details(path, self.kind_of(path), {'outcome': 'error', 'reason': str(e)})
+                    yield result
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.compressor.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+        return False
@@ -0,0 +1,234 @@
+"""Headless command line entry point for compressit.py
+
+Prints one JSON object per finished file to stdout and a final summary line
+with the throughput of the run. Everything else (progress, ffmpeg output,
+messages from the compressor) goes to stderr, so stdout can be piped straight
+into a log or another tool.
+
+Example:
+    python media_compressor_cli.py /data/photos --quality 80 --codec h265 \\
+        --threads 16 --video-workers 2 --engine process
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+
+from media_compressor import MediaCompressor, Tracer
+
+
+def thread_count(value):
+    """An image worker count or 'auto'"""
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number or 'auto', got {value!r}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compress images and videos without the GUI",
+        epilog="Per-file results and a final summary are written to stdout as JSON lines."
+    )
+    parser.add_argument('paths', nargs='+', type=Path, help="directories or files to compress")
+    parser.add_argument('-q', '--quality', type=int, default=80, help="quality from 1 to 100 (default: 80)")
+    parser.add_argument('--codec', choices=['h264', 'h265'], default='h265', help="video codec (default: h265)")
+    parser.add_argument('--lossy-png', action='store_true',
+                        help="let PNGs be reduced to a palette of up to 256 colours (fewer below quality 80)")
+    parser.add_argument('--pre-skip', action='store_true',
+                        help="with --in-place, skip JPEGs whose headers say re-encoding can't save 5%% "
+                             "without decoding them (an estimate)")
+    parser.add_argument('--no-hardware', dest='use_hardware', action='store_false',
+                        help="don't use hardware video encoders")
+    parser.add_argument('-j', '--threads', type=thread_count, default=multiprocessing.cpu_count(),
+                        help="image workers, or 'auto' to tune them during the run up to twice the CPUs "
+                             "(default: number of CPUs)")
+    parser.add_argument('--video-workers', type=int, default=1, help="parallel ffmpeg encodes (default: 1)")
+    parser.add_argument('--segment-workers', type=int,
+                        help="parallel segment encodes for long videos in software mode, 1 disables splitting "
+                             "(default: half the CPUs, at most 4)")
+    parser.add_argument('--engine', choices=['thread', 'process'], default='thread',
+                        help="run image workers as threads or processes (default: thread)")
+    parser.add_argument('-o', '--output-dir', type=Path,
+                        help="where compressed files go (default: 'compressed' next to the inputs)")
+    parser.add_argument('--layout', choices=['flat', 'mirror'], default='mirror',
+                        help="mirror the input tree or put all outputs in one directory (default: mirror); a "
+                             "file whose output would share another's name, extension aside, fails")
+    parser.add_argument('--in-place', action='store_true',
+                        help="replace the originals with their compressed versions, keeping names, permissions "
+                             "and times; no backup is kept")
+    parser.add_argument('--read-ahead', type=int,
+                        help="images read into memory ahead of the encoders, 0 disables (default: 2x threads)")
+    parser.add_argument('--read-ahead-mb', type=int, default=256, help="memory for read-ahead (default: 256)")
+    parser.add_argument('--write-behind', type=int,
+                        help="encoded images queued for writing, 0 writes inline (default: 2x threads)")
+    parser.add_argument('--write-behind-mb', type=int, default=256, help="memory for write-behind (default: 256)")
+    parser.add_argument('--io-threads', type=int, default=4, help="threads reading and writing each (default: 4)")
+    parser.add_argument('--memory-mb', type=int,
+                        help="memory for decoded images; larger images wait instead of decoding in parallel "
+                             "(default: no limit)")
+    parser.add_argument('--cache', type=Path, help="SQLite result cache, unchanged files are skipped on re-runs")
+    parser.add_argument('--journal', type=Path,
+                        help="log progress to this file; running the same command again after a crash or "
+                             "Ctrl+C resumes where it stopped")
+    parser.add_argument('--report', type=Path, help="also write every file's result to this .csv or .json file")
+    parser.add_argument('--trace', type=Path,
+                        help="record the time of every stage and save it as a Chrome trace (chrome://tracing, Perfetto)")
+    args = parser.parse_args(argv)
+
+    if not 1 <= args.quality <= 100:
+        parser.error("quality must be between 1 and 100")
+    if args.threads != 'auto' and args.threads < 1 or args.video_workers < 1 or (args.segment_workers is not None and args.segment_workers < 1):
+        parser.error("worker counts must be at least 1")
+    if args.io_threads < 1:
+        parser.error("--io-threads must be at least 1")
+    if args.memory_mb is not None and args.memory_mb < 1:
+        parser.error("--memory-mb must be at least 1")
+    if min(args.read_ahead or 0, args.write_behind or 0, args.read_ahead_mb, args.write_behind_mb) < 0:
+        parser.error("read-ahead and write-behind sizes can't be negative")
+    for path in args.paths:
+        if not path.exists():
+            parser.error(f"{path} does not exist")
+    if args.in_place and args.output_dir:
+        parser.error("--in-place and --output-dir can't be combined")
+    # Into an output directory JPEGs may become HEIF, which pre-skip never predicts
+    if args.pre_skip and not args.in_place:
+        parser.error("--pre-skip only works with --in-place")
+    if args.report and args.report.suffix.lower() not in ('.csv', '.json'):
+        parser.error("the report must be a .csv or .json file")
+    return args
+
+
+def iter_inputs(compressor, paths, output_dir):
+    """Yield the media files of every path, directories are walked lazily"""
+    for path in paths:
+        if path.is_dir():
+            yield from compressor.iter_media(path, exclude_paths=[output_dir] if output_dir else [])
+        elif path.suffix.lower() in compressor.supported_formats:
+            yield path
+        else:
+            print(f"Skipping unsupported file {path}", file=sys.stderr)
+
+
+def file_record(result):
+    """Turn a FileResult into the JSON line printed for it"""
+    return {
+        'file': str(result.path),
+        'status': result.outcome,
+        'input_bytes': result.input_bytes,
+        'output_bytes': result.output_bytes,
+        'output': str(result.output_path) if result.output_path else None,
+        'format': result.format,
+        'encoder': result.encoder,
+        'seconds': round(result.seconds, 3) if result.seconds is not None else None,
+        'reason': result.reason,
+        'probe': result.probe
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    inputs = [path.resolve() for path in args.paths]
+    source_root = Path(os.path.commonpath(inputs))
+    if not source_root.is_dir():
+        source_root = source_root.parent
+    if args.in_place:
+        output_dir = source_root
+    else:
+        output_dir = (args.output_dir or source_root / 'compressed').resolve()
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Results go to the real stdout, anything else that writes to fd 1 (our
+    # own prints, worker processes, ffmpeg) is sent to stderr instead
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'w', buffering=1)
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    cancelled = threading.Event()
+    def cancel(signum, frame):
+        print("Cancelling, waiting for running files to finish...", file=sys.stderr)
+        cancelled.set()
+    signal.signal(signal.SIGINT, cancel)
+    signal.signal(signal.SIGTERM, cancel)
+
+    def on_progress(event):
+        if isinstance(event, dict) and 'result' in event:
+            results.write(json.dumps(file_record(event['result'])) + '\n')
+
+    autotune = args.threads == 'auto'
+    threads = multiprocessing.cpu_count() * 2 if autotune else args.threads
+    tracer = Tracer() if args.trace else None
+    start = time.perf_counter()
+    with MediaCompressor() as compressor:
+        stats = compressor.compress_directory(
+            iter_inputs(compressor, inputs, None if args.in_place else output_dir),
+            output_dir,
+            args.quality,
+            threads,
+            progress_callback=on_progress,
+            cancel_check=cancelled.is_set,
+            use_hardware=args.use_hardware,
+            codec=args.codec,
+            replace_files=args.in_place,
+            engine=args.engine,
+            video_workers=args.video_workers,
+            cache=args.cache,
+            layout=args.layout,
+            source_root=source_root,
+            segment_workers=args.segment_workers,
+            tracer=tracer,
+            read_ahead=args.read_ahead,
+            read_ahead_bytes=args.read_ahead_mb * 1024 * 1024,
+            write_behind=args.write_behind,
+            write_behind_bytes=args.write_behind_mb * 1024 * 1024,
+            io_threads=args.io_threads,
+            journal=args.journal,
+            inputs={'paths': [str(path) for path in inputs], 'formats': sorted(compressor.supported_formats)},
+            memory_budget=args.memory_mb * 1024 * 1024 if args.memory_mb else None,
+            autotune=autotune,
+            lossy_png=args.lossy_png,
+            pre_skip_images=args.pre_skip
+        )
+        elapsed = time.perf_counter() - start
+        # Cached files weren't read this time and don't count towards throughput
+        input_bytes = sum(r.input_bytes or 0 for r in compressor.results if r.outcome != 'cached')
+        if args.report:
+            compressor.export_results(args.report)
+    if tracer:
+        tracer.save(args.trace)
+
+    summary = {
+        'summary': True,
+        'files': stats['total_files'],
+        'compressed': stats['successful'],
+        'skipped': stats['skipped'],
+        'cached': stats['cached'],
+        'errors': stats['errors'],
+        'cancelled': cancelled.is_set(),
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(stats['total_files'] / elapsed, 3) if elapsed > 0 else None,
+        'input_mb_per_second': round(input_bytes / elapsed / (1024 * 1024), 3) if elapsed > 0 else None,
+        'input_bytes': input_bytes,
+        'bytes_saved': stats['space_saved'],
+        'lanes': stats['lanes'],
+        'stages': stats['stages'],
+        'memory': stats['memory'],
+        'autotune': stats['autotune']
+    }
+    results.write(json.dumps(summary) + '\n')
+    results.close()
+
+    if cancelled.is_set():
+        return 130
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
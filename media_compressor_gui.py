@@ -1,6 +1,6 @@
 import tkinter as tk
 from tkinter import filedialog, ttk, messagebox
-from media_compressor import MediaCompressor
+from media_compressor import MediaCompressor, atomic_write
 import threading
 from pathlib import Path
 import webbrowser
@@ -8,6 +8,8 @@ import multiprocessing
 from concurrent.futures import ThreadPoolExecutor
 import json
 import os
+import queue
+import time
 import sv_ttk
 import darkdetect
 import sys
@@ -28,6 +30,11 @@ def get_sv_ttk_path():
     return os.path.join(base_path, 'sv_ttk')
 
 class MediaCompressorGUI:
+    # Progress is drawn at most this often (ms), events in between are coalesced
+    PROGRESS_INTERVAL_MS = 33
+    # Skips and errors are summed up into one notification at most this often (s)
+    NOTIFY_INTERVAL = 2.0
+
     def __init__(self, root):
         self.root = root
         self.root.title("compressit.py")
@@ -76,6 +83,7 @@ class MediaCompressorGUI:
         self.status_var = tk.StringVar(value="Select a directory to begin")
         self.quality_var = tk.StringVar(value="80")
         self.thread_var = tk.StringVar(value=str(multiprocessing.cpu_count()))
+        self.video_thread_var = tk.StringVar(value="1")
         self.file_count = tk.StringVar(value="Files: 0/0")
         
         # Add these lines to initialize the checkbox variables
@@ -90,8 +98,17 @@ class MediaCompressorGUI:
         self.compressor = MediaCompressor()
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
         self.compression_in_progress = False
+        # Filled by the workers, drained by the Tk loop in drain_progress
+        self.progress_queue = queue.SimpleQueue()
+        self.progress_job = None
+        self.pending_skips = {}
+        self.pending_errors = 0
+        self.last_notification = 0.0
         
         self.settings_file = Path.home() / '.compressit_settings.json'
+        self.cache_file = Path.home() / '.compressit_cache.sqlite'
+        # Lets an interrupted run of the same folder and settings pick up where it stopped
+        self.journal_file = Path.home() / '.compressit_journal.jsonl'
         self.load_settings()
         
         # GitHub icon in base64 (black version)
@@ -159,8 +176,10 @@ class MediaCompressorGUI:
         # Thread setting with more space
         thread_frame = ttk.Frame(settings_label_frame)
         thread_frame.pack(fill=tk.X, padx=10, pady=10)
-        ttk.Label(thread_frame, text="Threads:").pack(side=tk.LEFT)
+        ttk.Label(thread_frame, text="Threads (or auto):").pack(side=tk.LEFT)
         ttk.Entry(thread_frame, textvariable=self.thread_var, width=5).pack(side=tk.LEFT, padx=(10, 0))
+        ttk.Label(thread_frame, text="Video jobs:").pack(side=tk.LEFT, padx=(20, 0))
+        ttk.Entry(thread_frame, textvariable=self.video_thread_var, width=5).pack(side=tk.LEFT, padx=(10, 0))
 
         # Filetype frame with better spacing
         self.filetype_frame = ttk.Frame(self.main_frame)
@@ -203,7 +222,7 @@ class MediaCompressorGUI:
         # Add warning label
         warning_label = ttk.Label(
             replace_option_frame,
-            text="⚠️ Original files will be backed up to .compressit_backup",
+            text="⚠️ Originals are replaced in place, no backup is kept",
             foreground='orange'
         )
         warning_label.pack(side=tk.LEFT)
@@ -349,19 +368,32 @@ class MediaCompressorGUI:
             self.start_button.grid_remove()
             self.cancel_button.grid()
             self.compression_in_progress = True
+            if self.progress_job is not None:
+                self.root.after_cancel(self.progress_job)
+            self.progress_job = self.root.after(self.PROGRESS_INTERVAL_MS, self.drain_progress)
             
             # Get settings
             try:
                 quality = int(self.quality_var.get())
-                thread_count = int(self.thread_var.get())
+                threads = self.thread_var.get().strip().lower()
+                # auto tunes the image workers during the run, up to twice the CPUs
+                thread_count = multiprocessing.cpu_count() * 2 if threads == 'auto' else int(threads)
+                video_workers = int(self.video_thread_var.get())
             except ValueError:
-                messagebox.showerror("Error", "Quality and thread count must be numbers")
+                messagebox.showerror("Error", "Quality and thread counts must be numbers, threads can also be auto")
                 return
             
-            # Start compression in a separate thread
+            # Start compression in a separate thread, which gets the settings
+            # read here because Tk variables belong to this one
             self.compression_thread = threading.Thread(
                 target=self.run_compression,
-                args=(quality, thread_count)
+                args=(quality, thread_count, video_workers, threads == 'auto'),
+                kwargs={
+                    'use_hardware': self.hw_var.get(),
+                    'codec': self.codec_var.get(),
+                    'replace_files': self.replace_files_var.get(),
+                    'formats': self.get_media_formats()
+                }
             )
             self.compression_thread.start()
             
@@ -369,22 +401,22 @@ class MediaCompressorGUI:
             messagebox.showerror("Error", f"Failed to start compression: {str(e)}")
             self.compression_complete()
 
-    def run_compression(self, quality, thread_count):
+    def run_compression(self, quality, thread_count, video_workers=1, autotune=False, use_hardware=True,
+                        codec='h265', replace_files=False, formats=None):
         """Run the compression process"""
         try:
-            # Create compressor instance
-            self.compressor = MediaCompressor()
-            
-            # Get list of media files first
-            media_files = self.get_media_files()
-            if not media_files:
-                self.status_var.set("No files to process")
-                self.compression_complete()
-                return
-            
-            # Create output directory
-            output_dir = Path(self.directory) / 'compressed'
-            output_dir.mkdir(exist_ok=True)
+            # The compressor is reused so encoder detection and worker processes carry over
+            # Create output directory, replaced files stay where they are
+            if replace_files:
+                output_dir = Path(self.directory)
+                exclude_paths = []
+            else:
+                output_dir = Path(self.directory) / 'compressed'
+                output_dir.mkdir(exist_ok=True)
+                exclude_paths = [output_dir]
+            
+            # Files are found while the first ones are already compressing
+            media_files = self.get_media_files(formats, exclude_paths=exclude_paths)
             
             # Run compression with correct arguments
             stats = self.compressor.compress_directory(
@@ -392,17 +424,24 @@ class MediaCompressorGUI:
                 output_dir=output_dir,
                 quality=quality,
                 thread_count=thread_count,
+                video_workers=video_workers,
+                autotune=autotune,
                 progress_callback=self.update_progress,
-                use_hardware=self.hw_var.get(),
-                codec=self.codec_var.get(),
-                replace_files=self.replace_files_var.get(),
+                use_hardware=use_hardware,
+                codec=codec,
+                replace_files=replace_files,
+                cache=self.cache_file,
+                journal=self.journal_file,
+                inputs={'paths': [str(self.directory)], 'formats': sorted(formats)},
                 cancel_check=lambda: not self.compression_in_progress
             )
             
             # Store results
             self.compression_results = stats
             
-            # Update UI in main thread
+            # Update UI in main thread, Tk must not be touched from this one
+            if stats['total_files'] == 0:
+                self.root.after(0, self.status_var.set, "No files to process")
             self.root.after(0, self.compression_complete)
             
         except Exception as e:
@@ -411,35 +450,73 @@ class MediaCompressorGUI:
             self.root.after(0, self.compression_complete)
 
     def update_progress(self, progress_info):
-        """Update the progress bar and file count"""
-        if isinstance(progress_info, dict):
-            # Update progress bar if progress info exists
-            if 'progress' in progress_info:
-                self.progress['value'] = progress_info['progress']
+        """Progress callback, called from worker threads, so it only queues the event for drain_progress"""
+        self.progress_queue.put(progress_info)
+
+    def drain_progress(self, final=False):
+        """Apply all queued progress events at once, every PROGRESS_INTERVAL_MS on the Tk loop"""
+        self.progress_job = None
+        latest = None
+        status = None
+        while True:
+            try:
+                progress_info = self.progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(progress_info, dict):
+                if 'progress' in progress_info:
+                    latest = progress_info
                 
-                # Update file count
-                self.file_count.set(
-                    f"Files: {progress_info['files_processed']}/{progress_info['total_files']}"
-                )
-            
-            # Check for skipped files
-            if progress_info.get('skipped'):
-                self.show_notification(
-                    "File Skipped",
-                    f"Skipped: {progress_info['current_file']} ({progress_info.get('reason', 'unknown reason')})"
-                )
-            
-            # Update status for current file
-            if 'current_file' in progress_info:
-                current_file = progress_info['current_file']
-                self.status_var.set(f"Processing: {current_file}")
-        
-        elif isinstance(progress_info, str):
-            if progress_info == 'error':
-                self.show_notification(
-                    "Error",
-                    "An error occurred during compression"
-                )
+                # Live progress of a running video encode
+                if progress_info.get('video_progress'):
+                    status = f"Encoding: {progress_info['current_file']}"
+                    if 'percent' in progress_info:
+                        status += f" ({progress_info['percent']:.0f}%"
+                        if 'eta' in progress_info:
+                            status += f", ETA {progress_info['eta']:.0f}s"
+                        status += ")"
+                    if progress_info.get('speed'):
+                        status += f" | {progress_info['speed']:.2f}x"
+                    continue
+                
+                if progress_info.get('skipped'):
+                    reason = progress_info.get('reason', 'unknown reason')
+                    self.pending_skips[reason] = self.pending_skips.get(reason, 0) + 1
+                
+                if 'current_file' in progress_info:
+                    status = f"Processing: {progress_info['current_file']}"
+            elif progress_info == 'error':
+                self.pending_errors += 1
+        
+        # Only the newest counts are drawn
+        if latest is not None:
+            if latest['progress'] is None:
+                # Still scanning, the total isn't known yet
+                self.file_count.set(f"Files: {latest['files_found']} found / {latest['files_done']} done")
+            else:
+                self.progress['value'] = latest['progress']
+                self.file_count.set(f"Files: {latest['files_processed']}/{latest['total_files']}")
+        if status is not None:
+            self.status_var.set(status)
+        
+        # One notification sums up the skips and errors since the last one
+        if (self.pending_skips or self.pending_errors) and \
+                (final or time.monotonic() - self.last_notification >= self.NOTIFY_INTERVAL):
+            lines = []
+            if self.pending_skips:
+                skipped = sum(self.pending_skips.values())
+                reasons = ", ".join(f"{reason}: {count}" for reason, count in
+                                    sorted(self.pending_skips.items(), key=lambda item: -item[1]))
+                lines.append(f"{skipped} file{'s' if skipped != 1 else ''} skipped ({reasons})")
+            if self.pending_errors:
+                lines.append(f"{self.pending_errors} file{'s' if self.pending_errors != 1 else ''} failed")
+            self.show_notification("Errors" if self.pending_errors else "Files Skipped", "\n".join(lines))
+            self.pending_skips = {}
+            self.pending_errors = 0
+            self.last_notification = time.monotonic()
+        
+        if self.compression_in_progress and not final:
+            self.progress_job = self.root.after(self.PROGRESS_INTERVAL_MS, self.drain_progress)
 
     def cancel_compression(self):
         """Cancel the compression process"""
@@ -455,6 +532,9 @@ class MediaCompressorGUI:
     def compression_complete(self):
         """Handle completion of compression process"""
         self.compression_in_progress = False
+        if self.progress_job is not None:
+            self.root.after_cancel(self.progress_job)
+        self.drain_progress(final=True)
         
         # Update button visibility
         if hasattr(self, 'cancel_button'):
@@ -480,8 +560,9 @@ class MediaCompressorGUI:
         # Show the summary window
         CompressionSummaryWindow(self, self.compression_results)
         
-        # Update status
-        self.status_var.set("Compression complete! Switch to the summary window for details.")
+        # Update status, a run that found no files keeps saying so
+        if self.compression_results['total_files'] != 0:
+            self.status_var.set("Compression complete! Switch to the summary window for details.")
         self.progress['value'] = 100
 
     def open_github(self, event):
@@ -493,10 +574,12 @@ class MediaCompressorGUI:
                 self.is_cancelled = True
                 self.root.after(100, self.check_and_close)  # Check periodically if it's safe to close
         else:
+            self.compressor.close()
             self.root.destroy()
 
     def check_and_close(self):
         if not self.compression_in_progress:
+            self.compressor.close()
             self.root.destroy()
         else:
             self.root.after(100, self.check_and_close)  # Check again after 100ms
@@ -508,6 +591,7 @@ class MediaCompressorGUI:
                     settings = json.load(f)
                     self.quality_var.set(settings.get('quality', 80))
                     self.thread_var.set(settings.get('threads', multiprocessing.cpu_count()))
+                    self.video_thread_var.set(settings.get('video_threads', 1))
                     self.hw_var.set(settings.get('hw_acceleration', True))
                     self.codec_var.set(settings.get('codec', 'h264'))
         except Exception as e:
@@ -517,12 +601,12 @@ class MediaCompressorGUI:
         try:
             settings = {
                 'quality': int(self.quality_var.get()),
-                'threads': int(self.thread_var.get()),
+                'threads': 'auto' if self.thread_var.get().strip().lower() == 'auto' else int(self.thread_var.get()),
+                'video_threads': int(self.video_thread_var.get()),
                 'hw_acceleration': self.hw_var.get(),
                 'codec': self.codec_var.get()
             }
-            with open(self.settings_file, 'w') as f:
-                json.dump(settings, f)
+            atomic_write(self.settings_file, json.dumps(settings))
             messagebox.showinfo("Success", "Settings saved successfully")
         except Exception as e:
             messagebox.showerror("Error", f"Could not save settings: {e}")
@@ -661,39 +745,20 @@ class MediaCompressorGUI:
         except Exception as e:
             print(f"Error repositioning notifications: {e}")
 
-    def get_media_files(self):
-        """Get all media files from the selected directory"""
+    def get_media_formats(self):
+        """Extensions to process based on user preferences, only call this on the Tk thread"""
+        formats = set()
+        if self.process_images_var.get():
+            formats |= self.compressor.supported_image_formats
+        if self.process_videos_var.get():
+            formats |= self.compressor.supported_video_formats
+        return formats
+
+    def get_media_files(self, formats, exclude_paths=()):
+        """Yield the media files of the selected directory with these extensions as they are found"""
         if not hasattr(self, 'directory') or not self.directory:
-            return []
-        
-        media_files = []
-        supported_formats = {
-            'images': ['.jpg', '.jpeg', '.png', '.webp'],
-            'videos': ['.mp4', '.mov', '.avi', '.mkv', '.webm']
-        }
-        
-        try:
-            for root, _, files in os.walk(self.directory):
-                for file in files:
-                    file_path = Path(root) / file
-                    extension = file_path.suffix.lower()
-                    
-                    # Check if file should be processed based on user preferences
-                    is_image = extension in supported_formats['images']
-                    is_video = extension in supported_formats['videos']
-                    
-                    if ((is_image and self.process_images_var.get()) or 
-                        (is_video and self.process_videos_var.get())):
-                        media_files.append(file_path)
-            
-            # Sort files for consistent processing order
-            media_files.sort()
-            return media_files
-            
-        except Exception as e:
-            print(f"Error scanning directory: {e}")
-            self.status_var.set(f"Error scanning directory: {e}")
-            return []
+            return iter(())
+        return self.compressor.iter_media(self.directory, formats=formats, exclude_paths=exclude_paths)
 
 class CompressionSummaryWindow:
     def __init__(self, parent, compression_results):
@@ -702,8 +767,8 @@ class CompressionSummaryWindow:
         self.compression_results = compression_results
         
         self.window.title("Compression Summary")
-        self.window.geometry("500x600")
-        self.window.minsize(500, 600)
+        self.window.geometry("500x650")
+        self.window.minsize(500, 650)
         
         # Configure style
         self.style = ttk.Style()
@@ -774,6 +839,13 @@ class CompressionSummaryWindow:
             "Compression Ratio"
         )
         
+        # Per-file results of the run
+        ttk.Button(
+            main_frame,
+            text="Export Report",
+            command=self.export_report
+        ).pack(pady=(20, 0))
+        
         # Close button
         ttk.Button(
             main_frame,
@@ -781,6 +853,22 @@ class CompressionSummaryWindow:
             command=self.window.destroy
         ).pack(pady=20)
 
+    def export_report(self):
+        """Save the result of every file as CSV or JSON"""
+        path = filedialog.asksaveasfilename(
+            parent=self.window,
+            defaultextension='.csv',
+            filetypes=[("CSV", "*.csv"), ("JSON", "*.json")],
+            initialfile="compression_report.csv"
+        )
+        if not path:
+            return
+        try:
+            self.parent.compressor.export_results(path)
+            self.parent.show_notification("Report Saved", f"Saved the results of {len(self.parent.compressor.results)} files")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save report: {str(e)}", parent=self.window)
+
     def create_stat_pair(self, parent, row, value, label):
         """Helper method to create a stat value and label pair"""
         # Container for the pair
@@ -0,0 +1,45 @@
+"""Files written by atomic_write, in place and not"""
+import os
+import sys
+
+import pytest
+
+from media_compressor import atomic_write
+
+posix = pytest.mark.skipif(sys.platform == 'win32', reason="POSIX permissions")
+
+
+@posix
+def test_new_file_follows_the_umask(tmp_path):
+    old = os.umask(0o027)
+    try:
+        atomic_write(tmp_path / 'a.jpg', b'data')
+    finally:
+        os.umask(old)
+    assert (tmp_path / 'a.jpg').stat().st_mode & 0o777 == 0o640
+    assert os.listdir(tmp_path) == ['a.jpg']
+
+
+@posix
+def test_in_place_keeps_mode_and_times(tmp_path):
+    path = tmp_path / 'a.jpg'
+    path.write_bytes(b'original')
+    path.chmod(0o604)
+    os.utime(path, ns=(1_000_000_000, 2_000_000_000))
+    atomic_write(path, b'new', like=path)
+    st = path.stat()
+    assert path.read_bytes() == b'new'
+    assert st.st_mode & 0o777 == 0o604
+    assert st.st_mtime_ns == 2_000_000_000
+
+
+@pytest.mark.skipif(not hasattr(os, 'geteuid') or os.geteuid() != 0, reason="only root can give files away")
+def test_in_place_keeps_the_owner(tmp_path):
+    path = tmp_path / 'a.jpg'
+    path.write_bytes(b'original')
+    os.chown(path, 1000, 1000)
+    path.chmod(0o600)
+    atomic_write(path, b'new', like=path)
+    st = path.stat()
+    assert (st.st_uid, st.st_gid) == (1000, 1000)
+    assert st.st_mode & 0o777 == 0o600
@@ -0,0 +1,27 @@
+"""Parsing of ffmpeg's -progress output"""
+import pytest
+
+from media_compressor import _FfmpegProgress
+
+BLOCK = [b'frame=250\n', b'fps=50.0\n', b'out_time_us=5000000\n', b'speed=2.5x\n']
+
+
+def test_one_event_per_block():
+    progress = _FfmpegProgress(duration=10, current_file='clip.mp4')
+    assert [progress.feed(line) for line in BLOCK] == [None] * len(BLOCK)
+    event = progress.feed(b'progress=continue\n')
+    assert event['current_file'] == 'clip.mp4'
+    assert (event['frame'], event['fps'], event['out_time'], event['speed']) == (250, 50.0, 5.0, 2.5)
+    assert event['percent'] == pytest.approx(50)
+    assert event['eta'] == pytest.approx(2)
+    assert event['done'] is False
+
+
+def test_blocks_dont_carry_over():
+    progress = _FfmpegProgress()
+    for line in BLOCK:
+        progress.feed(line)
+    progress.feed(b'progress=continue\n')
+    event = progress.feed(b'progress=end\n')
+    assert event['done'] is True
+    assert event['frame'] is None and 'percent' not in event
@@ -0,0 +1,109 @@
+"""Hardware encoder detection against a stub ffmpeg, no GPU needed"""
+import os
+import sys
+import threading
+
+import pytest
+
+from media_compressor import MediaCompressor
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason="the stub ffmpeg is a script with a shebang")
+
+# Lists every encoder in STUB_LISTED and only lets trial encodes with one of
+# STUB_WORKING succeed. Each call is appended to STUB_LOG.
+STUB = '''#!{python}
+import os, sys
+with open(os.environ['STUB_LOG'], 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\\n')
+if '-encoders' in sys.argv:
+    print('Encoders:')
+    for name in os.environ['STUB_LISTED'].split():
+        print(' V....D ' + name + '  stub')
+    sys.exit(0)
+encoder = sys.argv[sys.argv.index('-vcodec') + 1]
+sys.exit(0 if encoder in os.environ['STUB_WORKING'].split() else 1)
+'''
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    ffmpeg = tmp_path / 'ffmpeg'
+    ffmpeg.write_text(STUB.format(python=sys.executable))
+    ffmpeg.chmod(0o755)
+    log = tmp_path / 'calls.log'
+    log.touch()
+    monkeypatch.setenv('STUB_LOG', str(log))
+    monkeypatch.setenv('STUB_LISTED', 'hevc_nvenc hevc_qsv h264_nvenc h264_vaapi')
+    monkeypatch.setenv('STUB_WORKING', 'hevc_qsv h264_nvenc')
+
+    def make():
+        return MediaCompressor(ffmpeg_path=str(ffmpeg), encoder_cache_file=tmp_path / 'encoders.json')
+
+    def calls():
+        return log.read_text().splitlines()
+
+    return ffmpeg, make, calls
+
+
+def trials(calls):
+    return [call.split('-vcodec ')[1].split()[0] for call in calls if '-vcodec' in call]
+
+
+def test_trial_encodes_pick_the_first_working_encoder(stub):
+    _, make, calls = stub
+    assert make().hw_encoders == {'h265': 'hevc_qsv', 'h264': 'h264_nvenc'}
+    # Listed encoders are tried in order of preference until one works,
+    # unlisted ones never
+    assert trials(calls()) == ['hevc_nvenc', 'hevc_qsv', 'h264_nvenc']
+
+
+def test_no_working_encoder(stub, monkeypatch):
+    _, make, _ = stub
+    monkeypatch.setenv('STUB_WORKING', '')
+    assert make().hw_encoders == {}
+
+
+def test_vaapi_trial_gets_the_device(stub, monkeypatch):
+    _, make, calls = stub
+    monkeypatch.setenv('STUB_LISTED', 'h264_vaapi')
+    monkeypatch.setenv('STUB_WORKING', 'h264_vaapi')
+    assert make().hw_encoders == {'h264': 'h264_vaapi'}
+    assert any('-vaapi_device' in call for call in calls())
+
+
+def test_cache_hit_runs_no_ffmpeg(stub):
+    _, make, calls = stub
+    first = make().hw_encoders
+    count = len(calls())
+    assert make().hw_encoders == first
+    assert len(calls()) == count
+
+
+def test_cache_invalidated_when_ffmpeg_changes(stub, monkeypatch):
+    ffmpeg, make, calls = stub
+    assert make().hw_encoders == {'h265': 'hevc_qsv', 'h264': 'h264_nvenc'}
+    count = len(calls())
+
+    monkeypatch.setenv('STUB_WORKING', 'hevc_nvenc')
+    st = ffmpeg.stat()
+    os.utime(ffmpeg, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert make().hw_encoders == {'h265': 'hevc_nvenc'}
+    assert len(calls()) > count
+
+
+def test_concurrent_first_calls_detect_once(stub):
+    _, make, calls = stub
+    compressor = make()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(compressor.hw_encoders)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 8 and all(result == results[0] for result in results)
+    assert sum('-encoders' in call for call in calls()) == 1
+
+
+def test_missing_ffmpeg(tmp_path):
+    compressor = MediaCompressor(ffmpeg_path=str(tmp_path / 'missing'), encoder_cache_file=tmp_path / 'encoders.json')
+    assert compressor.hw_encoders == {}
@@ -0,0 +1,35 @@
+"""Inputs whose outputs would overwrite each other"""
+from PIL import Image
+
+from media_compressor import MediaCompressor
+
+
+def make_photo(path):
+    Image.effect_noise((160, 120), 60).convert('RGB').save(path, quality=98)
+
+
+def outcomes(compressor):
+    return {r.path.name: (r.outcome, r.output_path.name if r.output_path else None) for r in compressor.results}
+
+
+def test_heic_and_jpg_of_one_name_clash(tmp_path):
+    compressor = MediaCompressor()
+    source = tmp_path / 'src'
+    source.mkdir()
+    make_photo(source / 'photo.jpg')
+    make_photo(source / 'photo.heic')
+    # HEIC outputs become JPEGs, both would be photo.jpg
+    compressor.compress_directory([source / 'photo.jpg', source / 'photo.heic'], tmp_path / 'out', 80, 1,
+                                  layout='mirror', source_root=source)
+    results = outcomes(compressor)
+    assert results['photo.jpg'] == ('compressed', 'photo.jpg')
+    assert results['photo.heic'][0] == 'error'
+
+
+def test_different_names_dont_clash(tmp_path):
+    compressor = MediaCompressor()
+    (tmp_path / 'out').mkdir()
+    make_photo(tmp_path / 'a.jpg')
+    make_photo(tmp_path / 'a.b.jpg')
+    compressor.compress_directory([tmp_path / 'a.jpg', tmp_path / 'a.b.jpg'], tmp_path / 'out', 80, 1)
+    assert {outcome for outcome, _ in outcomes(compressor).values()} == {'compressed'}
@@ -0,0 +1,64 @@
+"""The image process pool after one of its workers was killed"""
+import os
+import signal
+import sys
+import time
+
+import pytest
+from PIL import Image
+
+from media_compressor import MediaCompressor
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason="workers are killed with SIGKILL")
+
+
+@pytest.fixture
+def photos(tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+    (tmp_path / 'out').mkdir()
+    paths = []
+    for i in range(8):
+        path = source / f'photo{i}.jpg'
+        Image.effect_noise((200, 150), 60).convert('RGB').save(path, quality=98)
+        paths.append(path)
+    return paths
+
+
+def kill_a_worker(compressor):
+    pool = compressor._image_pool
+    os.kill(next(iter(pool._processes)), signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while not pool._broken and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert pool._broken
+
+
+def run(compressor, photos, tmp_path, **options):
+    return compressor.compress_directory(photos, tmp_path / 'out', 80, 2, engine='process', use_hardware=False,
+                                         **options)
+
+
+def test_next_run_replaces_a_broken_pool(photos, tmp_path):
+    with MediaCompressor() as compressor:
+        assert run(compressor, photos, tmp_path)['successful'] == len(photos)
+        kill_a_worker(compressor)
+        assert run(compressor, photos, tmp_path)['successful'] == len(photos)
+
+
+def test_worker_killed_during_a_run(photos, tmp_path):
+    with MediaCompressor() as compressor:
+        killed = []
+
+        def on_progress(event):
+            if isinstance(event, dict) and 'result' in event and not killed:
+                killed.append(True)
+                kill_a_worker(compressor)
+
+        stats = run(compressor, photos, tmp_path, progress_callback=on_progress, cache=tmp_path / 'cache.db',
+                    read_ahead=0, write_behind=0)
+        # Files the dead pool had fail, the others are compressed by a new one
+        assert stats['successful'] + stats['errors'] == len(photos)
+        assert stats['successful'] > 1
+        assert compressor.tracer is None
+        assert run(compressor, photos, tmp_path, cache=tmp_path / 'cache.db')['errors'] == 0
@@ -0,0 +1,128 @@
+"""When ResultCache.lookup lets a file skip a run and when it doesn't"""
+import os
+import shutil
+import subprocess
+
+import pytest
+from PIL import Image
+
+from media_compressor import MediaCompressor, ResultCache, _video_output_path
+
+SETTINGS = ResultCache.settings_key(80)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResultCache(tmp_path / 'cache.db')
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'src' / 'photo.jpg'
+    path.parent.mkdir()
+    path.write_bytes(b'original content')
+    return path
+
+
+def store_output(cache, source, output_path, outcome='compressed'):
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_bytes(b'output')
+    cache.store(source, SETTINGS, outcome, ResultCache.fingerprint(source), output_path)
+
+
+def test_unknown_file_misses(cache, source):
+    assert cache.lookup(source, SETTINGS) is None
+
+
+def test_compressed_hit_needs_the_same_output(cache, source, tmp_path):
+    store_output(cache, source, tmp_path / 'out' / 'photo.jpg')
+    assert cache.lookup(source, SETTINGS) == 'compressed'
+    assert cache.lookup(source, SETTINGS, tmp_path / 'out' / 'photo.jpg') == 'compressed'
+    # Another output directory or in place never got this output
+    assert cache.lookup(source, SETTINGS, tmp_path / 'other' / 'photo.jpg') is None
+    assert cache.lookup(source, SETTINGS, source) is None
+
+
+def test_image_output_may_change_suffix(cache, source, tmp_path):
+    # A JPEG that won as HEIF
+    store_output(cache, source, tmp_path / 'out' / 'photo.heic')
+    assert cache.lookup(source, SETTINGS, tmp_path / 'out' / 'photo.jpg') == 'compressed'
+
+
+def test_video_output_with_appended_mp4(cache, tmp_path):
+    source = tmp_path / 'src' / 'clip.mov'
+    source.parent.mkdir()
+    source.write_bytes(b'video')
+    output_path = tmp_path / 'out' / 'clip.mov'
+    written = _video_output_path(source, output_path)
+    assert written == str(output_path) + '.mp4'
+    store_output(cache, source, tmp_path / 'out' / 'clip.mov.mp4')
+    assert cache.lookup(source, SETTINGS, written) == 'compressed'
+
+
+def test_missing_output_misses(cache, source, tmp_path):
+    output_path = tmp_path / 'out' / 'photo.jpg'
+    store_output(cache, source, output_path)
+    output_path.unlink()
+    assert cache.lookup(source, SETTINGS, output_path) is None
+
+
+def test_skipped_hits_without_output(cache, source, tmp_path):
+    cache.store(source, SETTINGS, 'skipped', ResultCache.fingerprint(source))
+    assert cache.lookup(source, SETTINGS, tmp_path / 'anywhere' / 'photo.jpg') == 'skipped'
+
+
+def test_other_settings_miss(cache, source):
+    cache.store(source, SETTINGS, 'skipped', ResultCache.fingerprint(source))
+    assert cache.lookup(source, ResultCache.settings_key(60)) is None
+    assert cache.lookup(source, ResultCache.settings_key(80, lossy_png=True)) is None
+
+
+def test_changed_file_misses(cache, source):
+    cache.store(source, SETTINGS, 'skipped', ResultCache.fingerprint(source))
+    source.write_bytes(b'other content, longer')
+    assert cache.lookup(source, SETTINGS) is None
+
+
+def test_touched_file_hits_and_same_size_edit_misses(cache, source):
+    cache.store(source, SETTINGS, 'skipped', ResultCache.fingerprint(source))
+    st = source.stat()
+    os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert cache.lookup(source, SETTINGS) == 'skipped'
+
+    source.write_bytes(b'ORIGINAL CONTENT')
+    os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 2_000_000_000))
+    assert cache.lookup(source, SETTINGS) is None
+
+
+def run_twice(sources, tmp_path, **options):
+    results = []
+    for _ in range(2):
+        compressor = MediaCompressor()
+        compressor.compress_directory(sources, tmp_path / 'out', 80, 1, cache=tmp_path / 'cache.db',
+                                      use_hardware=False, **options)
+        results.append({r.path.name: r.outcome for r in compressor.results})
+    return results
+
+
+def test_second_directory_run_is_cached(tmp_path):
+    (tmp_path / 'out').mkdir()
+    source = tmp_path / 'photo.jpg'
+    Image.effect_noise((320, 240), 60).convert('RGB').save(source, quality=98)
+    first, second = run_twice([source], tmp_path)
+    assert first == {'photo.jpg': 'compressed'}
+    assert second == {'photo.jpg': 'cached'}
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg'), reason="ffmpeg is needed")
+def test_second_directory_run_is_cached_for_mov(tmp_path):
+    (tmp_path / 'out').mkdir()
+    source = tmp_path / 'clip.mov'
+    subprocess.run(['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-y', '-f', 'lavfi',
+                    '-i', 'testsrc2=size=320x180:rate=25:duration=1,noise=alls=30:allf=t+u',
+                    '-c:v', 'libx264', '-crf', '5', '-pix_fmt', 'yuv420p', str(source)], check=True)
+    first, second = run_twice([source], tmp_path, codec='h264')
+    assert first == {'clip.mov': 'compressed'}
+    assert second == {'clip.mov': 'cached'}
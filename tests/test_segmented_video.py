@@ -0,0 +1,67 @@
+"""Segmented software encoding of long videos, needs ffmpeg and ffprobe"""
+import shutil
+import subprocess
+
+import ffmpeg
+import pytest
+
+import media_compressor
+from media_compressor import MediaCompressor
+
+pytestmark = pytest.mark.skipif(not (shutil.which('ffmpeg') and shutil.which('ffprobe')),
+                                reason="ffmpeg and ffprobe are needed")
+
+
+def make_clip(path, seconds, audio=True):
+    """Noisy test pattern with a keyframe every second and an optional sine tone"""
+    args = ['ffmpeg', '-hide_banner', '-nostdin', '-loglevel', 'error', '-y',
+            '-f', 'lavfi', '-i', f"testsrc2=size=320x180:rate=25:duration={seconds},noise=alls=12:allf=t+u"]
+    if audio:
+        args += ['-f', 'lavfi', '-i', f"sine=frequency=440:duration={seconds}", '-c:a', 'aac']
+    args += ['-c:v', 'libx264', '-crf', '12', '-preset', 'veryfast', '-g', '25', '-pix_fmt', 'yuv420p', str(path)]
+    subprocess.run(args, check=True)
+
+
+def streams_and_duration(path):
+    info = ffmpeg.probe(str(path))
+    streams = info['streams']
+    video = next(s for s in streams if s['codec_type'] == 'video')
+    duration = float(video.get('duration') or info['format']['duration'])
+    return sorted(s['codec_type'] for s in streams), duration
+
+
+@pytest.fixture
+def short_segments(monkeypatch):
+    monkeypatch.setattr(media_compressor, '_SEGMENT_MIN_DURATION', 4)
+    monkeypatch.setattr(media_compressor, '_SEGMENT_SECONDS', 2)
+
+
+@pytest.mark.parametrize('audio', [True, False])
+def test_segmented_output_matches_input(tmp_path, short_segments, audio):
+    source = tmp_path / 'clip.mp4'
+    output = tmp_path / 'out' / 'clip.mp4'
+    output.parent.mkdir()
+    make_clip(source, 10, audio)
+
+    details = {}
+    result = MediaCompressor().compress_video(source, output, 28, use_hardware=False, codec='h264',
+                                              details=details, pre_skip=False, segment_workers=3)
+
+    assert result, details
+    assert details['segmented'], "the encode fell back to a single pass"
+    source_streams, source_duration = streams_and_duration(source)
+    output_streams, output_duration = streams_and_duration(output)
+    assert output_streams == source_streams
+    # Each of the 5 segment boundaries may move the end by up to a frame
+    assert output_duration == pytest.approx(source_duration, abs=5 / 25)
+    # No segment directories or temp files are left behind
+    assert [p.name for p in output.parent.iterdir()] == ['clip.mp4']
+
+
+def test_short_videos_are_not_segmented(tmp_path, short_segments):
+    source = tmp_path / 'clip.mp4'
+    make_clip(source, 3)
+    details = {}
+    MediaCompressor().compress_video(source, tmp_path / 'out.mp4', 28, use_hardware=False, codec='h264',
+                                     details=details, pre_skip=False, segment_workers=3)
+    assert details['segmented'] is False